@@ -0,0 +1,228 @@
+import argparse
+import csv
+import os
+
+import numpy as np
+from sqlalchemy.sql import text
+
+from categories.classify_article_by_topic import get_topics_two_way_dicts
+from db.db_conf import get_engine
+
+# Category graph kept in memory as CSR arrays over dense node indices.
+# Nodes are pages (articles and categories) that are in categorylinks,
+# edges go from a page to the categories it's in. Topics of all pages
+# are found at once with a breadth-first search that starts from the
+# root categories of topics (topics.yml) and goes down the reversed
+# edges, so every category is visited once per level instead of once
+# per article. Like get_article_topic a page gets the topics of the
+# nearest roots only (all of them if several are equally near).
+
+CATEGORY_PREFIX = 'Категорія:'
+CATEGORY_NS = 14
+PAGES_TABLE = 'wiki_test.pages'
+CATEGORYLINKS_TABLE = 'wiki.categorylinks'
+NO_DISTANCE = -1
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output", help="CSV file with topics of articles")
+    parser.add_argument("--max-depth", type=int, default=11)
+    return parser
+
+
+def category_page_title(cl_to):
+    """Returns title of category page given categorylinks.cl_to"""
+    if isinstance(cl_to, bytes):
+        cl_to = cl_to.decode('utf-8')
+    return CATEGORY_PREFIX + cl_to.replace('_', ' ')
+
+
+class CategoryGraph:
+    """
+    node_ids[i] is page id of node i. Categories of node i are
+    indices[indptr[i]:indptr[i + 1]]. is_category[i] tells if node i
+    is a category page (if it's known).
+    """
+    def __init__(self, node_ids, indptr, indices, is_category=None):
+        self.node_ids = node_ids
+        self.indptr = indptr
+        self.indices = indices
+        if is_category is None:
+            # categories without members can't be told apart this way
+            is_category = np.zeros(len(node_ids), dtype=bool)
+            is_category[indices] = True
+        self.is_category = is_category
+
+    @classmethod
+    def from_edges(cls, from_ids, to_ids, category_ids=None):
+        """
+        Builds graph from arrays of page ids of edges and optionally
+        ids of all category pages
+        """
+        from_ids = np.asarray(from_ids, dtype=np.int64)
+        to_ids = np.asarray(to_ids, dtype=np.int64)
+        node_ids, inverse = np.unique(
+            np.concatenate([from_ids, to_ids]), return_inverse=True
+        )
+        sources = inverse[:len(from_ids)]
+        targets = inverse[len(from_ids):]
+        order = np.argsort(sources, kind='stable')
+        indptr = np.zeros(len(node_ids) + 1, dtype=np.int64)
+        np.cumsum(
+            np.bincount(sources, minlength=len(node_ids)), out=indptr[1:]
+        )
+        is_category = None
+        if category_ids is not None:
+            is_category = np.isin(
+                node_ids, np.asarray(category_ids, dtype=np.int64)
+            )
+        return cls(
+            node_ids, indptr, targets[order].astype(np.int32), is_category
+        )
+
+    @classmethod
+    def from_db(cls, engine=None, pages_table=PAGES_TABLE,
+                categorylinks_table=CATEGORYLINKS_TABLE):
+        """
+        Loads categorylinks with two queries. Links to categories
+        that have no page are dropped.
+        """
+        engine = engine or get_engine()
+        with engine.connect() as conn:
+            category_ids = {
+                title: id_ for id_, title in conn.execute(text(
+                    'select id, title from {} where ns = :ns'.format(
+                        pages_table
+                    )
+                ), ns=CATEGORY_NS)
+            }
+            from_ids = []
+            to_ids = []
+            links = conn.execution_options(stream_results=True).execute(
+                text('select cl_from, cl_to from {}'.format(
+                    categorylinks_table
+                ))
+            )
+            for cl_from, cl_to in links:
+                to_id = category_ids.get(category_page_title(cl_to))
+                if to_id is not None:
+                    from_ids.append(cl_from)
+                    to_ids.append(to_id)
+        return cls.from_edges(
+            from_ids, to_ids, list(category_ids.values())
+        )
+
+    @classmethod
+    def load(cls, file_name):
+        with np.load(file_name) as arrays:
+            return cls(
+                arrays['node_ids'], arrays['indptr'], arrays['indices'],
+                arrays['is_category'],
+            )
+
+    def save(self, file_name):
+        # np.savez adds .npz to names without it
+        tmp_file = file_name + '.tmp.npz'
+        np.savez(
+            tmp_file, node_ids=self.node_ids, indptr=self.indptr,
+            indices=self.indices, is_category=self.is_category,
+        )
+        os.replace(tmp_file, file_name)
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def node_index(self, page_id):
+        """Returns index of page's node or None if it's not in the graph"""
+        index = np.searchsorted(self.node_ids, page_id)
+        if index < len(self.node_ids) and self.node_ids[index] == page_id:
+            return int(index)
+        return None
+
+    def reversed(self):
+        """Returns (indptr, indices) of edges from categories to members"""
+        counts = np.diff(self.indptr)
+        sources = np.repeat(np.arange(len(self), dtype=np.int32), counts)
+        order = np.argsort(self.indices, kind='stable')
+        indptr = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum(
+            np.bincount(self.indices, minlength=len(self)), out=indptr[1:]
+        )
+        return indptr, sources[order]
+
+    def topic_masks(self, root_masks, max_depth=11):
+        """
+        root_masks is {page id of a root category: topic bitmask}.
+        Returns (masks, distances) arrays by node: bitmask of topics
+        of the nearest roots and number of links to them (NO_DISTANCE
+        if there are none within max_depth links).
+        """
+        masks = np.zeros(len(self), dtype=np.uint64)
+        distances = np.full(len(self), NO_DISTANCE, dtype=np.int32)
+        frontier = []
+        for page_id, mask in root_masks.items():
+            index = self.node_index(page_id)
+            if index is not None:
+                masks[index] |= np.uint64(mask)
+                distances[index] = 0
+                frontier.append(index)
+        frontier = np.unique(np.array(frontier, dtype=np.int64))
+        indptr, members = self.reversed()
+        for depth in range(1, max_depth + 1):
+            if not len(frontier):
+                break
+            starts = indptr[frontier]
+            counts = indptr[frontier + 1] - starts
+            # positions of members of all frontier categories in members
+            positions = (
+                np.repeat(starts - np.cumsum(counts) + counts, counts)
+                + np.arange(counts.sum())
+            )
+            children = members[positions]
+            parents = np.repeat(frontier, counts)
+            new = distances[children] == NO_DISTANCE
+            children, parents = children[new], parents[new]
+            np.bitwise_or.at(masks, children, masks[parents])
+            distances[children] = depth
+            frontier = np.unique(children)
+        return masks, distances
+
+
+def get_root_masks(cat_id_to_topic, topics):
+    """Returns {root category id: bitmask} with bits in order of topics"""
+    bits = {topic: 1 << bit for bit, topic in enumerate(topics)}
+    root_masks = {}
+    for cat_id, topic in cat_id_to_topic.items():
+        root_masks[cat_id] = root_masks.get(cat_id, 0) | bits[topic]
+    return root_masks
+
+
+def mask_to_topics(mask, topics):
+    return tuple(
+        topic for bit, topic in enumerate(topics) if int(mask) >> bit & 1
+    )
+
+
+def classify_all(graph, max_depth=11):
+    """
+    Yields (page id, topics) of every page in the graph that has
+    topics. Unlike get_article_topic roots themselves have topics too.
+    """
+    topics_to_cat, cat_id_to_topic = get_topics_two_way_dicts()
+    topics = list(topics_to_cat)
+    masks, _ = graph.topic_masks(
+        get_root_masks(cat_id_to_topic, topics), max_depth
+    )
+    for index in np.flatnonzero(masks):
+        yield int(graph.node_ids[index]), mask_to_topics(masks[index], topics)
+
+
+if __name__ == '__main__':
+    args = get_arg_parser().parse_args()
+    graph = CategoryGraph.from_db()
+    with open(args.output, 'w', newline='', encoding='utf-8') as output:
+        writer = csv.writer(output)
+        writer.writerow(['page_id', 'topics'])
+        for page_id, topics in classify_all(graph, args.max_depth):
+            writer.writerow([page_id, '|'.join(topics)])
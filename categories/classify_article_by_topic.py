@@ -4,9 +4,8 @@ import sys
 from sqlalchemy.sql import text
 import yaml
 
-from db.db_conf import engine
-from db.db_conf import TestSession
-from db.wiki_tables import Page
+from db.db_conf import get_engine
+from db.title_resolver import TitleResolver
 
 TOPICS_FILE = path.join(path.dirname(
     path.realpath(__file__)), 'topics.yml'
@@ -16,7 +15,7 @@ TOPICS_FILE = path.join(path.dirname(
 
 def get_topics_two_way_dicts():
     with open(TOPICS_FILE) as topics_file:
-        topics_to_cat = yaml.load(topics_file)
+        topics_to_cat = yaml.safe_load(topics_file)
     cat_id_to_topic = {}
     for topic, cats in topics_to_cat.items():
         for cat_name, cat_id in cats:
@@ -26,14 +25,6 @@ def get_topics_two_way_dicts():
     return topics_to_cat, cat_id_to_topic
 
 
-# TODO stop duplicating this code!
-def get_page_id_by_title(title):
-    session = TestSession()
-    return (session.query(Page.id)
-            .filter(Page.title == title)
-            .one())
-
-
 def get_article_topic(article_id, cat_topic_dict, max_depth=11):
     query = text(
         "select id from "
@@ -45,7 +36,7 @@ def get_article_topic(article_id, cat_topic_dict, max_depth=11):
         "where catlinks.cl_from in :id_list"
     )
     ids_list = (article_id, )
-    with engine.connect() as conn:
+    with get_engine().connect() as conn:
         for _ in range(max_depth):
             rs = conn.execute(query, id_list=tuple(ids_list)).fetchall()
             ids_list = set(r[0] for r in rs)
@@ -57,5 +48,7 @@ def get_article_topic(article_id, cat_topic_dict, max_depth=11):
 
 if __name__ == '__main__':
     topics_to_cat, cat_id_to_topic = get_topics_two_way_dicts()
-    page_id = get_page_id_by_title(sys.argv[1])[0]
+    page_id = TitleResolver().resolve_one(sys.argv[1])
+    if page_id is None:
+        sys.exit('No page {}'.format(sys.argv[1]))
     print(get_article_topic(page_id, cat_id_to_topic))
@@ -0,0 +1,208 @@
+import argparse
+import hashlib
+import json
+import os
+from os import path
+
+import numpy as np
+from sqlalchemy.sql import text
+
+from categories.category_graph import CATEGORYLINKS_TABLE
+from categories.category_graph import CategoryGraph
+from categories.category_graph import get_root_masks
+from categories.category_graph import mask_to_topics
+from categories.category_graph import PAGES_TABLE
+from categories.classify_article_by_topic import get_topics_two_way_dicts
+from categories.classify_article_by_topic import TOPICS_FILE
+from common.arrays import save_array
+from db.db_conf import get_engine
+
+
+# Topics of articles precomputed and stored on disk so that lookups
+# don't have to touch the category graph. The index is a directory with
+#   graph.npz         - category graph the index was built from
+#   masks.npy         - uint64 topic bitmasks indexed by page id
+#   topic_pages.npy   - sorted article ids of every topic, one after
+#                       another, topic_offsets.npy has their bounds
+#   state.json        - topics in order of bits and fingerprints of
+#                       topics.yml and categorylinks
+# Arrays are memory-mapped when read. A rebuild reloads the graph only
+# if categorylinks changed and does nothing if topics.yml didn't
+# change either.
+
+GRAPH_FILE = 'graph.npz'
+MASKS_FILE = 'masks.npy'
+TOPIC_PAGES_FILE = 'topic_pages.npy'
+TOPIC_OFFSETS_FILE = 'topic_offsets.npy'
+STATE_FILE = 'state.json'
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("index_dir")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser(
+        'build', help="Build or update the index"
+    )
+    build_parser.add_argument("--max-depth", type=int, default=11)
+    build_parser.add_argument(
+        "--force", action="store_true", help="Reload the category graph"
+    )
+    topics_parser = subparsers.add_parser(
+        'topics', help="Print topics of an article"
+    )
+    topics_parser.add_argument("page_id", type=int)
+    pages_parser = subparsers.add_parser(
+        'pages', help="Print ids of articles in a topic"
+    )
+    pages_parser.add_argument("topic")
+    return parser
+
+
+def topics_fingerprint(topics_file=TOPICS_FILE):
+    with open(topics_file, 'rb') as file_:
+        return hashlib.sha1(file_.read()).hexdigest()
+
+
+def categorylinks_fingerprint(engine, pages_table=PAGES_TABLE,
+                              categorylinks_table=CATEGORYLINKS_TABLE):
+    """Something that changes when categorylinks or categories change"""
+    with engine.connect() as conn:
+        links = conn.execute(text(
+            'select count(*), max(cl_timestamp) from {}'.format(
+                categorylinks_table
+            )
+        )).fetchone()
+        categories = conn.execute(text(
+            'select count(*), max(id) from {} where ns = 14'.format(
+                pages_table
+            )
+        )).fetchone()
+    return json.dumps([list(links), list(categories)], default=str)
+
+
+class TopicIndex:
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        os.makedirs(index_dir, exist_ok=True)
+        self.state = {}
+        if path.exists(self._path(STATE_FILE)):
+            with open(self._path(STATE_FILE), encoding='utf-8') as file_:
+                self.state = json.load(file_)
+        self._arrays = None
+
+    def _path(self, file_name):
+        return path.join(self.index_dir, file_name)
+
+    @property
+    def topics(self):
+        return self.state.get('topics', [])
+
+    def build(self, engine=None, max_depth=11, force=False,
+              pages_table=PAGES_TABLE,
+              categorylinks_table=CATEGORYLINKS_TABLE):
+        """
+        Builds the index or brings it up to date, returns True if
+        anything had to be recomputed.
+        """
+        engine = engine or get_engine()
+        links_state = categorylinks_fingerprint(
+            engine, pages_table, categorylinks_table
+        )
+        topics_state = topics_fingerprint()
+        graph_file = self._path(GRAPH_FILE)
+        graph_is_fresh = (
+            not force and path.exists(graph_file)
+            and self.state.get('categorylinks') == links_state
+        )
+        if (
+            graph_is_fresh and self.state.get('topics_file') == topics_state
+            and self.state.get('max_depth') == max_depth
+        ):
+            return False
+        if graph_is_fresh:
+            graph = CategoryGraph.load(graph_file)
+        else:
+            graph = CategoryGraph.from_db(
+                engine, pages_table, categorylinks_table
+            )
+            graph.save(graph_file)
+        topics_to_cat, cat_id_to_topic = get_topics_two_way_dicts()
+        topics = list(topics_to_cat)
+        masks, _ = graph.topic_masks(
+            get_root_masks(cat_id_to_topic, topics), max_depth
+        )
+        self._save_masks(graph, masks, len(topics))
+        self.state = {
+            'topics': topics, 'topics_file': topics_state,
+            'categorylinks': links_state, 'max_depth': max_depth,
+        }
+        # state goes last so that it never describes arrays
+        # that weren't saved
+        tmp_file = self._path(STATE_FILE + '.tmp')
+        with open(tmp_file, 'w', encoding='utf-8') as file_:
+            json.dump(self.state, file_, ensure_ascii=False, indent=2)
+        os.replace(tmp_file, self._path(STATE_FILE))
+        self._arrays = None
+        return True
+
+    def _save_masks(self, graph, masks, topics_number):
+        articles = ~graph.is_category & (masks != 0)
+        page_ids = graph.node_ids[articles]
+        article_masks = masks[articles]
+        masks_by_id = np.zeros(
+            int(page_ids.max()) + 1 if len(page_ids) else 0, dtype=np.uint64
+        )
+        masks_by_id[page_ids] = article_masks
+        save_array(self._path(MASKS_FILE), masks_by_id)
+        topic_pages = [
+            page_ids[article_masks >> np.uint64(bit) & np.uint64(1) != 0]
+            for bit in range(topics_number)
+        ]
+        offsets = np.zeros(topics_number + 1, dtype=np.int64)
+        np.cumsum([len(pages) for pages in topic_pages], out=offsets[1:])
+        save_array(
+            self._path(TOPIC_PAGES_FILE),
+            np.concatenate(topic_pages + [np.empty(0, np.int64)]),
+        )
+        save_array(self._path(TOPIC_OFFSETS_FILE), offsets)
+
+    def _load(self):
+        if self._arrays is None:
+            self._arrays = tuple(
+                np.load(self._path(file_name), mmap_mode='r')
+                for file_name in (
+                    MASKS_FILE, TOPIC_PAGES_FILE, TOPIC_OFFSETS_FILE
+                )
+            )
+        return self._arrays
+
+    def mask_of(self, page_id):
+        """Returns topic bitmask of the article (0 if it has none)"""
+        masks = self._load()[0]
+        if 0 <= page_id < len(masks):
+            return int(masks[page_id])
+        return 0
+
+    def topics_of(self, page_id):
+        """Returns tuple of topics of the article"""
+        return mask_to_topics(self.mask_of(page_id), self.topics)
+
+    def pages_in_topic(self, topic):
+        """Returns sorted array of ids of articles in the topic"""
+        _, topic_pages, offsets = self._load()
+        bit = self.topics.index(topic)
+        return topic_pages[offsets[bit]:offsets[bit + 1]]
+
+
+if __name__ == '__main__':
+    args = get_arg_parser().parse_args()
+    index = TopicIndex(args.index_dir)
+    if args.command == 'build':
+        if not index.build(max_depth=args.max_depth, force=args.force):
+            print('Index is up to date')
+    elif args.command == 'topics':
+        print(', '.join(index.topics_of(args.page_id)))
+    else:
+        for page_id in index.pages_in_topic(args.topic):
+            print(page_id)
@@ -0,0 +1,13 @@
+import os
+
+import numpy as np
+
+
+def save_array(file_name, array):
+    """
+    Saves array as .npy file, it's written next to it first and then
+    renamed so that readers never see a partly written file
+    """
+    tmp_file = file_name + '.tmp.npy'
+    np.save(tmp_file, array)
+    os.replace(tmp_file, file_name)
@@ -0,0 +1,63 @@
+from contextlib import contextmanager
+from os import path
+import shutil
+import subprocess
+
+PIPE_BUFFER_SIZE = 1024 * 1024
+
+
+# Reading of compressed files without extracting them, shared by the
+# pagecount and dump parsers. Decompressors are given as a table of
+#   extension: (external decompressor commands in order of preference,
+#               python fallback open or None)
+# where a command is a list that the file name is appended to. External
+# decompressors run in a separate process (parallel ones even in
+# several), so decompression goes on alongside parsing.
+
+
+@contextmanager
+def open_compressed(file_name, decompressors, use_external=True,
+                    buffer_size=PIPE_BUFFER_SIZE):
+    """
+    Opens file for binary reading, files with extensions from
+    decompressors are decompressed on the fly. The output of an
+    external decompressor is read from a pipe, if none of them is
+    installed (or use_external is False) the fallback is used.
+    """
+    extension = path.splitext(file_name)[1]
+    if extension not in decompressors:
+        with open(file_name, 'rb') as file_:
+            yield file_
+        return
+    commands, fallback_open = decompressors[extension]
+    command = None
+    if use_external or fallback_open is None:
+        command = next(
+            (command for command in commands if shutil.which(command[0])),
+            None,
+        )
+    if command is None and fallback_open is None:
+        raise IOError('No decompressor for {} is installed'.format(file_name))
+    if command is None:
+        with fallback_open(file_name, 'rb') as file_:
+            yield file_
+        return
+    process = subprocess.Popen(
+        command + [file_name], stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL, bufsize=buffer_size,
+    )
+    try:
+        yield process.stdout
+        # the file can be closed before it's read till the end,
+        # the decompressor is killed in that case
+        if process.stdout.read(1):
+            return
+        if process.wait() != 0:
+            raise IOError(
+                '{} failed to decompress {}'.format(command[0], file_name)
+            )
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.stdout.close()
+        process.wait()
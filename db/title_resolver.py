@@ -0,0 +1,214 @@
+import argparse
+from collections import OrderedDict
+import time
+
+from sqlalchemy import bindparam
+from sqlalchemy import inspect
+from sqlalchemy import select
+from sqlalchemy.sql import text
+
+from db.db_conf import get_engine
+from db.wiki_tables import Page
+from db.wiki_tables import title_hash
+
+
+# Resolves page titles to ids in batches. Titles are looked up by their
+# hashes (Page.title_hash is indexed) with one IN query per chunk, and
+# the titles of found rows are compared in python, so the match is exact
+# whatever the collation of the title column (the default MySQL one
+# treats 'Білі хорвати' and 'білі хорвати' as equal).
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--db-url", help="Database to use instead of the test one"
+    )
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser(
+        'backfill', help="Add title_hash to the pages table and fill it"
+    )
+    resolve_parser = subparsers.add_parser('resolve', help="Print page ids")
+    resolve_parser.add_argument("titles", nargs='+')
+    return parser
+
+
+def pageview_title(page_title):
+    """Returns title as it is in pagecount files given page title"""
+    return page_title.replace(' ', '_')
+
+
+class LRUCache:
+    """
+    Cache of the last maxsize items put, with ttl (seconds) items
+    also expire ttl seconds after they're put
+    """
+    def __init__(self, maxsize, ttl=None, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        # key: (expiry time or None, value)
+        self.items = OrderedDict()
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        item = self.items.get(key)
+        if item is not None and item[0] is not None and (
+            item[0] <= self.clock()
+        ):
+            del self.items[key]
+            item = None
+        if item is None:
+            self.misses += 1
+            return default
+        self.items.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def put(self, key, value):
+        expires_at = None if self.ttl is None else self.clock() + self.ttl
+        self.items[key] = (expires_at, value)
+        self.items.move_to_end(key)
+        if len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def clear(self):
+        self.items.clear()
+
+
+class TitleResolver:
+    """
+    Maps titles to page ids. Results (misses included) of the last
+    cache_size titles are cached.
+    """
+    _missing = object()
+
+    def __init__(self, engine=None, chunk_size=1000,
+                 cache_size=2**16):
+        self.engine = engine or get_engine('test')
+        self.chunk_size = chunk_size
+        self.cache = LRUCache(cache_size)
+
+    def _query(self, titles):
+        """Returns {title: id} of titles found in the db"""
+        found = {}
+        hashes = {}
+        for title in titles:
+            hashes.setdefault(title_hash(title), set()).add(title)
+        hashes_list = list(hashes)
+        with self.engine.connect() as conn:
+            for start in range(0, len(hashes_list), self.chunk_size):
+                chunk = hashes_list[start:start + self.chunk_size]
+                rows = conn.execute(
+                    select([Page.id, Page.title, Page.title_hash])
+                    .where(Page.title_hash.in_(chunk))
+                )
+                for id_, title, hash_ in rows:
+                    # hash collisions and other titles are dropped here
+                    if title in hashes[hash_]:
+                        found[title] = id_
+        return found
+
+    def resolve(self, titles):
+        """Returns {title: page id} of titles that have a page"""
+        result = {}
+        unknown = set()
+        for title in titles:
+            id_ = self.cache.get(title, self._missing)
+            if id_ is self._missing:
+                unknown.add(title)
+            elif id_ is not None:
+                result[title] = id_
+        if unknown:
+            found = self._query(unknown)
+            for title in unknown:
+                self.cache.put(title, found.get(title))
+            result.update(found)
+        return result
+
+    def resolve_one(self, title):
+        """Returns page id of title or None if there's no such page"""
+        return self.resolve([title]).get(title)
+
+
+def get_titles(engine, page_ids, chunk_size=1000):
+    """Returns {page id: title} of pages that exist"""
+    page_ids = list(page_ids)
+    titles = {}
+    with engine.connect() as conn:
+        for start in range(0, len(page_ids), chunk_size):
+            rows = conn.execute(
+                select([Page.id, Page.title])
+                .where(Page.id.in_(page_ids[start:start + chunk_size]))
+            )
+            titles.update((id_, title) for id_, title in rows)
+    return titles
+
+
+def has_title_hash(engine):
+    """Tells if the pages table has the title_hash column"""
+    columns = inspect(engine).get_columns(Page.__table__.name)
+    return any(column['name'] == 'title_hash' for column in columns)
+
+
+def check_title_hash(engine):
+    """
+    Raises ValueError if the pages table was created before title_hash
+    was added, inserts and queries of pages fail on such tables
+    """
+    if not has_title_hash(engine):
+        raise ValueError(
+            'The pages table has no title_hash column, add it with '
+            '"python -m db.title_resolver backfill" (with --db-url '
+            'for databases other than the test one)'
+        )
+
+
+def backfill_title_hashes(engine, batch_size=10000):
+    """
+    Adds title_hash column with its index to an existing pages table
+    and computes hashes of pages that don't have them
+    """
+    table = Page.__table__
+    if not has_title_hash(engine):
+        with engine.begin() as conn:
+            conn.execute(text(
+                'alter table {} add column title_hash bigint'.format(
+                    table.name
+                )
+            ))
+    for index in table.indexes:
+        index.create(engine, checkfirst=True)
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(
+                select([table.c.id, table.c.title])
+                .where(table.c.title_hash.is_(None))
+                .where(table.c.title.isnot(None))
+                .limit(batch_size)
+            ).fetchall()
+            if not rows:
+                return
+            conn.execute(
+                table.update()
+                .where(table.c.id == bindparam('page_id'))
+                .values(title_hash=bindparam('hash')),
+                [
+                    {'page_id': id_, 'hash': title_hash(title)}
+                    for id_, title in rows
+                ],
+            )
+
+
+if __name__ == '__main__':
+    args = get_arg_parser().parse_args()
+    engine = get_engine('test', url=args.db_url)
+    if args.command == 'backfill':
+        backfill_title_hashes(engine)
+    else:
+        ids = TitleResolver(engine).resolve(args.titles)
+        for title in args.titles:
+            print(ids.get(title), title)
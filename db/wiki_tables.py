@@ -1,8 +1,13 @@
+import hashlib
+
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy import BigInteger
 from sqlalchemy import Column
 from sqlalchemy import ForeignKey
+from sqlalchemy import Index
 from sqlalchemy import Integer
+from sqlalchemy import String
 from sqlalchemy.types import DateTime
 from sqlalchemy.types import Text as TextType
 
@@ -10,12 +15,27 @@ from sqlalchemy.types import Text as TextType
 Base = declarative_base()
 
 
+def title_hash(title):
+    """Signed 64-bit hash of title used to look pages up by title"""
+    return int.from_bytes(
+        hashlib.md5(title.encode('utf-8')).digest()[:8], 'big', signed=True
+    )
+
+
+def default_title_hash(context):
+    title = context.get_current_parameters().get('title')
+    return None if title is None else title_hash(title)
+
+
 class Page(Base):
     __tablename__ = 'pages'
 
     id = Column(Integer, primary_key=True)
     title = Column(TextType)
     ns = Column(Integer)  # namespace
+    # titles are looked up by hash, the column is indexed and
+    # (unlike title) doesn't depend on collation of the db
+    title_hash = Column(BigInteger, index=True, default=default_title_hash)
 
     # relations
     revisions = relationship(
@@ -30,6 +50,10 @@ class Page(Base):
 
 class Revision(Base):
     __tablename__ = 'revisions'
+    __table_args__ = (
+        # history of a page in time order (viz.text_size_vs_time)
+        Index('ix_revisions_page_id_timestamp', 'page_id', 'timestamp'),
+    )
 
     id = Column(Integer, primary_key=True)
     comment = Column(TextType)
@@ -57,6 +81,30 @@ class Revision(Base):
         )
 
 
+class RevisionStats(Base):
+    __tablename__ = 'revision_stats'
+
+    # no foreign key to revisions, stats are computed in other
+    # processes and can be inserted before their revisions
+    revision_id = Column(Integer, primary_key=True)
+    page_id = Column(Integer)
+    byte_size = Column(Integer)
+    # size change relative to the parent revision,
+    # NULL if the parent isn't in the same page of the same dump
+    size_delta = Column(Integer)
+    links = Column(Integer)
+    categories = Column(Integer)
+    templates = Column(Integer)
+    # sha1 of the text, same hashes within a page mean reverts
+    sha1 = Column(String(40))
+
+    def __repr__(self):
+        return 'Stats of revision #{id}: {size} bytes ({delta:+})'.format(
+            id=self.revision_id, size=self.byte_size,
+            delta=self.size_delta or 0,
+        )
+
+
 # existing classes
 # TODO make this work with created classes!
 # maybe for start just use another declarative base
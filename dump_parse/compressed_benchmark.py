@@ -0,0 +1,88 @@
+"""
+Compares loading a compressed dump by streaming it into parse_xml
+with extracting it to disk first and parsing the extracted file.
+Both load into throwaway SQLite databases with a BulkLoader.
+
+    python -m dump_parse.compressed_benchmark \
+        ukwiki-20161001-pages-meta-history1.xml.bz2 -n 10000
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from db.wiki_tables import Base
+from dump_parse.dump_xml_parser import BulkLoader
+from dump_parse.dump_xml_parser import open_dump
+from dump_parse.dump_xml_parser import parse_xml
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("file_name", help="bz2 or 7z dump")
+    parser.add_argument(
+        "-n", "--page-number", type=int, help="Number of pages to parse"
+    )
+    parser.add_argument(
+        "-d", "--tmp-dir", help="Where to extract the dump and put databases"
+    )
+    return parser
+
+
+def load(xml_file, tmp_dir, page_limit):
+    """Returns number of loaded pages"""
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as db_dir:
+        engine = create_engine(
+            'sqlite:///' + os.path.join(db_dir, 'wiki.db')
+        )
+        Base.metadata.create_all(engine)
+        bulk_loader = BulkLoader(engine)
+        parse_xml(
+            xml_file, sessionmaker(bind=engine), engine,
+            page_limit=page_limit, bulk_loader=bulk_loader,
+        )
+        engine.dispose()
+    return bulk_loader.pages_loaded
+
+
+def extract_then_parse(file_name, tmp_dir=None, page_limit=None):
+    with tempfile.NamedTemporaryFile(dir=tmp_dir, suffix='.xml') as xml_file:
+        with open_dump(file_name) as dump_file:
+            shutil.copyfileobj(dump_file, xml_file)
+        xml_file.seek(0)
+        return load(xml_file, tmp_dir, page_limit)
+
+
+def stream_parse(file_name, tmp_dir=None, page_limit=None):
+    with open_dump(file_name) as dump_file:
+        return load(dump_file, tmp_dir, page_limit)
+
+
+def measure(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    args = get_arg_parser().parse_args()
+    kwargs = {'tmp_dir': args.tmp_dir, 'page_limit': args.page_number}
+    pages, extract_time = measure(
+        extract_then_parse, args.file_name, **kwargs
+    )
+    streamed_pages, stream_time = measure(
+        stream_parse, args.file_name, **kwargs
+    )
+    assert pages == streamed_pages
+    print('Loaded {} pages'.format(pages))
+    print('extract then parse: {:.2f}s ({:.0f} pages/s)'.format(
+        extract_time, pages / extract_time
+    ))
+    print('streaming parse:    {:.2f}s ({:.0f} pages/s)'.format(
+        stream_time, pages / stream_time
+    ))
+    print('speedup: {:.2f}x'.format(extract_time / stream_time))
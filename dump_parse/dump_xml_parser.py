@@ -1,19 +1,24 @@
 import argparse
+import bz2
 from collections import namedtuple
+from contextlib import ExitStack
+from datetime import datetime
 import logging
 
 from lxml import etree
 
-from db.db_conf import engine
-from db.db_conf import test_engine
-from db.db_conf import Session
-from db.db_conf import TestSession
+from common.compressed import open_compressed
+from db.db_conf import get_engine
+from db.db_conf import get_sessionmaker
+from db.db_conf import get_settings
+from db.title_resolver import check_title_hash
+from db.wiki_tables import Base
 from db.wiki_tables import Page
 from db.wiki_tables import Revision
+from db.wiki_tables import RevisionStats
+from dump_parse.revision_stats import RevisionStatsExtractor
 
 
-# TODO deal with these sessions!
-session = Session()
 LOGGER = logging.getLogger('xml-parser')
 LOGGER.addHandler(logging.FileHandler(
     '/home/zlira/wiki_pageviews/logs/xml_parser.log'
@@ -22,9 +27,30 @@ stream_handler = logging.StreamHandler()
 stream_handler.setLevel(logging.INFO)
 LOGGER.addHandler(stream_handler)
 LOGGER.setLevel(logging.INFO)
-logging.getLogger('sqlalchemy.engine').setLevel(logging.INFO)
 
 tagged_event = namedtuple('TaggedEvent', ['event', 'tag'])
+DUMP_FILE = (
+    '/media/storage/zlira/wiki/dumps/'
+    'ukwiki-20161001-pages-meta-history.xml'
+)
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+# extension: (external decompressor commands in order of preference,
+# python fallback or None), see common.compressed
+DECOMPRESSORS = {
+    '.bz2': (
+        (['lbzip2', '-dc'], ['pbzip2', '-dc'], ['bzip2', '-dc']), bz2.open
+    ),
+    '.7z': ((['7z', 'x', '-so'], ['7za', 'x', '-so'], ['7zr', 'x', '-so']),
+            None),
+}
+# column orders of page and revision rows used by BulkLoader,
+# columns with defaults (title_hash) are filled in by sqlalchemy
+PAGE_COLUMNS = tuple(
+    column.name for column in Page.__table__.columns
+    if column.default is None
+)
+REVISION_COLUMNS = tuple(Revision.__table__.columns.keys())
+COMMENT_INDEX = REVISION_COLUMNS.index('comment')
 
 
 def get_arg_parser():
@@ -35,11 +61,51 @@ def get_arg_parser():
     parser.add_argument(
         "-t", "--test", action="store_true", help="Use test database"
     )
+    parser.add_argument(
+        "-b", "--bulk", action="store_true",
+        help="Insert pages and revisions in large batches"
+    )
+    parser.add_argument(
+        "--batch-rows", type=int, default=get_settings()['batch_rows'],
+        help="Rows (pages and revisions) per batch in bulk mode"
+    )
+    parser.add_argument(
+        "--echo", action="store_true", help="Log every sql statement"
+    )
+    parser.add_argument(
+        "--fast", action="store_true",
+        help="Use the fast parser (implies --bulk)"
+    )
+    parser.add_argument(
+        "--stats", action="store_true",
+        help="Save text statistics of revisions (implies --fast)"
+    )
+    parser.add_argument(
+        "--stats-workers", type=int,
+        help="Number of processes computing text statistics"
+    )
+    parser.add_argument(
+        "--db-url",
+        help="Database to load into instead of the configured ones, "
+             "e.g. sqlite:///wiki.db (tables are created if needed)"
+    )
+    parser.add_argument(
+        "-f", "--file", default=DUMP_FILE, help="Dump file to parse"
+    )
     return parser
 
 # helpers
 
 
+def open_dump(file_name):
+    """
+    Opens dump for binary reading. bz2 and 7z dumps are streamed
+    through an external decompressor process (bz2 ones through python's
+    bz2 module if there's none), so they never have to be extracted.
+    """
+    return open_compressed(file_name, DECOMPRESSORS)
+
+
 def tag_wo_ns(element):
     """Strips the namespace from tag name if it's present"""
     return element.tag.split('}')[-1]
@@ -88,6 +154,13 @@ def set_dict_item_from_xml_elem(dict_, xml_elem):
     dict_[tag_wo_ns(xml_elem)] = xml_elem.text
 
 
+def set_revision_timestamp(rev_dict, xml_timestamp):
+    # parsed here because not every db accepts strings for DateTime
+    rev_dict['timestamp'] = datetime.strptime(
+        xml_timestamp.text, TIMESTAMP_FORMAT
+    )
+
+
 def set_revision_text(rev_dict, xml_text):
     rev_dict['text_size'] = (
         0 if xml_text.text is None else len(xml_text.text)
@@ -136,8 +209,9 @@ def process_revision_xml(xml_eater):
     revision = {}
     end_handlers = {
         elem_tag: set_dict_item_from_xml_elem for elem_tag in
-        ('comment', 'timestamp', 'parentid', )
+        ('comment', 'parentid', )
     }
+    end_handlers['timestamp'] = set_revision_timestamp
     end_handlers['contributor'] = set_revision_contributor
     end_handlers['text'] = set_revision_text
     end_handlers['id'] = set_revision_id
@@ -145,10 +219,12 @@ def process_revision_xml(xml_eater):
         if event == 'end':
             stripped_tag = tag_wo_ns(element)
             if stripped_tag == 'revision':
-                # comment tag can be missing but it's needed
-                # to insert into db and defualtdict isn't
+                # comment and parentid tags can be missing but
+                # they're needed to insert into db (executemany takes
+                # columns from the first row) and defualtdict isn't
                 # working here
                 revision['comment'] = revision.get('comment')
+                revision['parentid'] = revision.get('parentid')
 
                 element.clear()
                 return revision
@@ -158,8 +234,118 @@ def process_revision_xml(xml_eater):
                 )
 
 
-def parse_xml(xml_file, session_maker, engine, page_limit=None):
-    session = session_maker()
+class BulkLoader:
+    """
+    Accumulates pages with their revisions and inserts them with
+    executemany in one transaction per batch. A batch is flushed when
+    it has max_rows rows or max_bytes of comments. If a batch fails
+    its pages are inserted again one by one, each in its own
+    transaction, so a single bad page doesn't lose the whole batch.
+    on_flush is called with the loader after every batch.
+    """
+    def __init__(self, engine, max_rows=50000, max_bytes=64 * 1024 ** 2,
+                 on_flush=None):
+        if engine is not None:
+            # otherwise every page of an old database fails on its own
+            check_title_hash(engine)
+        self.engine = engine
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.on_flush = on_flush
+        self.pages_loaded = 0
+        self.pages_failed = 0
+        self._reset()
+
+    def _reset(self):
+        self.pages = []
+        self.rows = 0
+        self.bytes = 0
+
+    def add(self, page, revisions):
+        """Adds page (a Page instance) and a list of revision dicts"""
+        self.add_rows(
+            tuple(getattr(page, column) for column in PAGE_COLUMNS),
+            [
+                tuple(revision.get(column) for column in REVISION_COLUMNS)
+                for revision in revisions
+            ],
+        )
+
+    def add_rows(self, page_row, revision_rows):
+        """
+        Adds page and its revisions as tuples with values in the order
+        of PAGE_COLUMNS and REVISION_COLUMNS. page_row is None if the
+        page is already in the database.
+        """
+        self.pages.append((page_row, revision_rows))
+        self.rows += 1 + len(revision_rows)
+        # comments are the only long strings in rows
+        self.bytes += sum([
+            len(revision[COMMENT_INDEX]) for revision in revision_rows
+            if revision[COMMENT_INDEX]
+        ])
+        if self.rows >= self.max_rows or self.bytes >= self.max_bytes:
+            self.flush()
+
+    def _insert(self, conn, pages):
+        page_rows = [
+            dict(zip(PAGE_COLUMNS, page)) for page, _ in pages
+            if page is not None
+        ]
+        if page_rows:
+            conn.execute(Page.__table__.insert(), page_rows)
+        revisions = [
+            dict(zip(REVISION_COLUMNS, rev)) for _, revs in pages
+            for rev in revs
+        ]
+        if revisions:
+            conn.execute(Revision.__table__.insert(), revisions)
+
+    def flush(self):
+        if not self.pages:
+            return
+        try:
+            with self.engine.begin() as conn:
+                self._insert(conn, self.pages)
+            self.pages_loaded += len(self.pages)
+        except Exception:
+            LOGGER.warning(
+                'Batch of %d pages failed, inserting them one by one',
+                len(self.pages), exc_info=True,
+            )
+            self._insert_one_by_one()
+        LOGGER.info(
+            'Loaded %d pages (%d failed)', self.pages_loaded, self.pages_failed
+        )
+        self._reset()
+        if self.on_flush is not None:
+            self.on_flush(self)
+
+    def _insert_one_by_one(self):
+        for page in self.pages:
+            try:
+                with self.engine.begin() as conn:
+                    self._insert(conn, [page])
+                self.pages_loaded += 1
+            except Exception:
+                self.pages_failed += 1
+                page_row, revisions = page
+                LOGGER.exception(
+                    'Error while inserting page: %s',
+                    revisions[0][REVISION_COLUMNS.index('page_id')]
+                    if page_row is None
+                    else page_row[PAGE_COLUMNS.index('title')]
+                )
+
+
+def parse_xml(xml_file, session_maker, engine, page_limit=None,
+              bulk_loader=None):
+    """
+    Loads pages and revisions from xml_file to the database. By default
+    every page is committed separately, with bulk_loader they are
+    inserted in batches.
+    """
+    session = session_maker() if bulk_loader is None else None
     xml_eater = etree.iterparse(xml_file, ('start', 'end'))
     page_counter = 0
     revisions = []
@@ -167,18 +353,25 @@ def parse_xml(xml_file, session_maker, engine, page_limit=None):
         tagged_event_ = get_tagged_event(event, element)
         if tagged_event_ == tagged_event('start', 'page'):
             page = process_page_xml(xml_eater)
-            session.add(page)
+            if bulk_loader is None:
+                session.add(page)
         elif tagged_event_ == tagged_event('start', 'revision'):
             rev = process_revision_xml(xml_eater)
             rev['page_id'] = page.id
             revisions.append(rev)
+        elif tagged_event_ == tagged_event('end', 'page') and bulk_loader:
+            bulk_loader.add(page, revisions)
+            page_counter += 1
+            element.clear()
+            revisions = []
+            while element.getprevious() is not None:
+                del element.getparent()[0]
         elif tagged_event_ == tagged_event('end', 'page'):
             page_title = find_in_default_ns(element, 'title').text
             try:
                 session.commit()
                 session.expunge_all()
 
-                # FIXME parentid is not included for some reason!
                 engine.execute(
                     Revision.__table__.insert(), revisions
                 )
@@ -194,20 +387,176 @@ def parse_xml(xml_file, session_maker, engine, page_limit=None):
                 while element.getprevious() is not None:
                     del element.getparent()[0]
         if page_limit and page_counter >= page_limit:
-            return
+            break
+    if bulk_loader:
+        bulk_loader.flush()
 
 
-if __name__ == '__main__':
-    file_path = (
-        '/media/storage/zlira/wiki/dumps/'
-        'ukwiki-20161001-pages-meta-history.xml'
+# Fast path: only 'end' events of pages and revisions are generated
+# (lxml filters the rest), children are matched against tags with the
+# namespace precomputed and revisions are built as tuples.
+
+
+def make_qualified_tags(namespace):
+    """Returns a dict of tag names to tags qualified with namespace"""
+    return {
+        tag: '{{{}}}{}'.format(namespace, tag) if namespace else tag
+        for tag in (
+            'page', 'revision', 'title', 'ns', 'id', 'parentid', 'timestamp',
+            'contributor', 'ip', 'comment', 'text',
+        )
+    }
+
+
+def parse_timestamp(timestamp):
+    """Faster equivalent of strptime with TIMESTAMP_FORMAT"""
+    return datetime.fromisoformat(timestamp[:-1])
+
+
+def read_page_row(page_element, tags):
+    values = {}
+    for child in page_element:
+        if child.tag in (tags['id'], tags['title'], tags['ns']):
+            values[child.tag] = child.text
+        elif child.tag == tags['revision']:
+            break
+    return tuple(values.get(tags[column]) for column in PAGE_COLUMNS)
+
+
+def fast_parse_xml(xml_file, bulk_loader, page_limit=None,
+                   stats_extractor=None):
+    """
+    Same as parse_xml with bulk_loader, but faster. Rows passed to
+    bulk_loader are the same. Texts of revisions are passed to
+    stats_extractor (a RevisionStatsExtractor) if it's given, in parts
+    of up to its batch_bytes so that long histories aren't kept in
+    memory.
+    """
+    xml_eater = etree.iterparse(
+        xml_file, events=('end', ), tag=('{*}page', '{*}revision')
+    )
+    tags = None
+    page_id_index = PAGE_COLUMNS.index('id')
+    # positions of values in revision rows
+    (
+        id_index, parentid_index, comment_index, timestamp_index,
+        user_ip_index, user_id_index, text_size_index, revision_page_index,
+    ) = (
+        REVISION_COLUMNS.index(column) for column in (
+            'id', 'parentid', 'comment', 'timestamp', 'user_ip', 'user_id',
+            'text_size', 'page_id',
+        )
     )
+    empty_row = [None] * len(REVISION_COLUMNS)
+    page_counter = 0
+    page_element = page_row = None
+    revisions = []
+    texts = []
+    texts_size = 0
+    for _, element in xml_eater:
+        if tags is None:
+            tags = make_qualified_tags(etree.QName(element).namespace)
+            revision_tag, id_tag = tags['revision'], tags['id']
+            timestamp_tag, contributor_tag = (
+                tags['timestamp'], tags['contributor']
+            )
+            text_tag, ip_tag = tags['text'], tags['ip']
+            # children of revision that are copied as they are
+            text_indexes = {
+                id_tag: id_index, tags['parentid']: parentid_index,
+                tags['comment']: comment_index,
+            }
+        if element.tag == revision_tag:
+            if page_element is None:
+                page_element = element.getparent()
+                page_row = read_page_row(page_element, tags)
+                empty_row[revision_page_index] = page_row[page_id_index]
+            row = empty_row[:]
+            text = None
+            for child in element:
+                tag = child.tag
+                index = text_indexes.get(tag)
+                if index is not None:
+                    row[index] = child.text
+                elif tag == timestamp_tag:
+                    row[timestamp_index] = parse_timestamp(child.text)
+                elif tag == text_tag:
+                    text = child.text
+                    row[text_size_index] = 0 if text is None else len(text)
+                elif tag == contributor_tag:
+                    for contributor_child in child:
+                        if contributor_child.tag == ip_tag:
+                            row[user_ip_index] = contributor_child.text
+                        elif contributor_child.tag == id_tag:
+                            row[user_id_index] = contributor_child.text
+            revisions.append(tuple(row))
+            if stats_extractor is not None:
+                texts.append((row[id_index], row[parentid_index], text))
+                texts_size += row[text_size_index] or 0
+                if texts_size >= stats_extractor.batch_bytes:
+                    stats_extractor.add(
+                        page_row[page_id_index], texts, more=True
+                    )
+                    texts = []
+                    texts_size = 0
+            # revisions are removed with their page
+            element.clear()
+        else:
+            # pages without revisions
+            if page_element is None:
+                page_row = read_page_row(element, tags)
+            bulk_loader.add_rows(page_row, revisions)
+            if texts:
+                stats_extractor.add(page_row[page_id_index], texts)
+            page_counter += 1
+            page_element = page_row = None
+            revisions = []
+            texts = []
+            texts_size = 0
+            element.clear()
+            # clear previous pages
+            parent = element.getparent()
+            while element.getprevious() is not None:
+                del parent[0]
+            if page_limit and page_counter >= page_limit:
+                break
+    bulk_loader.flush()
+
+
+if __name__ == '__main__':
     arg_parser = get_arg_parser()
     args = arg_parser.parse_args()
-    with open(file_path, 'rb') as xml_file:
-        parse_xml(
-            xml_file,
-            session_maker=Session if not args.test else TestSession,
-            engine=engine if not args.test else test_engine,
-            page_limit=args.page_number,
-        )
+    db_name = 'test' if args.test else 'main'
+    # without --echo WIKI_DB_ECHO decides
+    engine_options = {'url': args.db_url, 'echo': args.echo or None}
+    engine = get_engine(db_name, **engine_options)
+    if args.db_url:
+        Base.metadata.create_all(engine)
+    elif args.stats:
+        # the configured database may predate the stats table
+        RevisionStats.__table__.create(engine, checkfirst=True)
+    check_title_hash(engine)
+    session_maker = get_sessionmaker(db_name, **engine_options)
+    bulk_loader = (
+        BulkLoader(engine, max_rows=args.batch_rows)
+        if args.bulk or args.fast or args.stats else None
+    )
+    with ExitStack() as stack:
+        xml_file = stack.enter_context(open_dump(args.file))
+        if args.stats:
+            fast_parse_xml(
+                xml_file, bulk_loader, args.page_number,
+                stats_extractor=stack.enter_context(
+                    RevisionStatsExtractor(engine, args.stats_workers)
+                ),
+            )
+        elif args.fast:
+            fast_parse_xml(xml_file, bulk_loader, args.page_number)
+        else:
+            parse_xml(
+                xml_file,
+                session_maker=session_maker,
+                engine=engine,
+                page_limit=args.page_number,
+                bulk_loader=bulk_loader,
+            )
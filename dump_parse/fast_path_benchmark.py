@@ -0,0 +1,178 @@
+"""
+Compares parse_xml in bulk mode with fast_parse_xml on a synthetic
+dump. Rows aren't inserted anywhere, they're collected and compared
+so both parsers have to produce identical rows.
+
+    python -m dump_parse.fast_path_benchmark -p 2000 -r 10
+"""
+import argparse
+import gc
+import hashlib
+import io
+import random
+import time
+from datetime import datetime
+from datetime import timedelta
+from xml.sax.saxutils import escape
+
+from lxml import etree
+
+from dump_parse.dump_xml_parser import BulkLoader
+from dump_parse.dump_xml_parser import fast_parse_xml
+from dump_parse.dump_xml_parser import parse_xml
+from dump_parse.dump_xml_parser import TIMESTAMP_FORMAT
+
+
+ROOT_START_TAG = (
+    '<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/" '
+    'version="0.10" xml:lang="uk">\n'
+)
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--pages", type=int, default=2000)
+    parser.add_argument(
+        "-r", "--revisions", type=int, default=10,
+        help="Average number of revisions per page"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    return parser
+
+
+def generate_revision(rev_id, parent_id, timestamp, random_):
+    lines = ['    <revision>', '      <id>{}</id>'.format(rev_id)]
+    if parent_id is not None:
+        lines.append('      <parentid>{}</parentid>'.format(parent_id))
+    lines.append('      <timestamp>{}</timestamp>'.format(
+        timestamp.strftime(TIMESTAMP_FORMAT)
+    ))
+    lines.append('      <contributor>')
+    if random_.random() < 0.3:
+        lines.append('        <ip>10.0.{}.{}</ip>'.format(
+            random_.randrange(256), random_.randrange(256)
+        ))
+    else:
+        lines.append('        <username>User{}</username>'.format(rev_id))
+        lines.append('        <id>{}</id>'.format(random_.randrange(10000)))
+    lines.append('      </contributor>')
+    if random_.random() < 0.5:
+        lines.append('      <comment>{}</comment>'.format(
+            escape('Правка & <{}>'.format(rev_id))
+        ))
+    lines.append('      <model>wikitext</model>')
+    lines.append('      <format>text/x-wiki</format>')
+    if random_.random() < 0.05:
+        lines.append('      <text xml:space="preserve" />')
+    else:
+        text = 'Текст [[Посилання]] {{Шаблон}} ' * random_.randrange(8)
+        lines.append('      <text xml:space="preserve">{}</text>'.format(
+            escape(text)
+        ))
+    lines.append('      <sha1>abc</sha1>')
+    lines.append('    </revision>')
+    return lines
+
+
+def generate_dump(pages, revisions, seed=0):
+    """Returns bytes of a dump with pages and about revisions per page"""
+    random_ = random.Random(seed)
+    lines = [ROOT_START_TAG.rstrip()]
+    lines.append('  <siteinfo>\n    <sitename>Вікіпедія</sitename>\n'
+                 '  </siteinfo>')
+    rev_id = 0
+    for page_id in range(1, pages + 1):
+        lines.append('  <page>')
+        lines.append('    <title>{}</title>'.format(
+            escape('Сторінка "{}" & Ко'.format(page_id))
+        ))
+        lines.append('    <ns>{}</ns>'.format(random_.choice((0, 0, 1, 14))))
+        lines.append('    <id>{}</id>'.format(page_id))
+        timestamp = datetime(2004, 1, 1) + timedelta(
+            seconds=random_.randrange(10 ** 8)
+        )
+        parent_id = None
+        for _ in range(random_.randrange(2 * revisions + 1)):
+            rev_id += 1
+            lines.extend(
+                generate_revision(rev_id, parent_id, timestamp, random_)
+            )
+            parent_id = rev_id
+            timestamp += timedelta(seconds=random_.randrange(10 ** 6))
+        lines.append('  </page>')
+    lines.append('</mediawiki>')
+    return '\n'.join(lines).encode('utf-8')
+
+
+class CollectingLoader(BulkLoader):
+    """BulkLoader that keeps rows instead of inserting them"""
+    def __init__(self):
+        super().__init__(engine=None)
+        self.collected = []
+
+    def flush(self):
+        self.collected.extend(self.pages)
+        self.pages_loaded += len(self.pages)
+        self._reset()
+
+
+def rows_digest(pages):
+    """Hash of rows normalized so that rows of both parsers are comparable"""
+    digest = hashlib.sha1()
+    for page, revisions in pages:
+        for row in [page] + revisions:
+            digest.update(repr(tuple(
+                None if value is None else str(value) for value in row
+            )).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def count_events(dump):
+    return sum(1 for _ in etree.iterparse(io.BytesIO(dump), ('start', 'end')))
+
+
+def run_legacy(dump):
+    loader = CollectingLoader()
+    parse_xml(io.BytesIO(dump), None, None, bulk_loader=loader)
+    return loader.collected
+
+
+def run_fast(dump):
+    loader = CollectingLoader()
+    fast_parse_xml(io.BytesIO(dump), loader)
+    return loader.collected
+
+
+def measure(func, *args):
+    """Returns (digest of rows, seconds) of func"""
+    # like timeit, no garbage collection while collected rows pile up
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        pages = func(*args)
+        seconds = time.perf_counter() - start
+    finally:
+        gc.enable()
+    return (rows_digest(pages), len(pages), sum(
+        len(revisions) for _, revisions in pages
+    )), seconds
+
+
+if __name__ == '__main__':
+    args = get_arg_parser().parse_args()
+    dump = generate_dump(args.pages, args.revisions, args.seed)
+    events = count_events(dump)
+    legacy_result, legacy_time = measure(run_legacy, dump)
+    fast_result, fast_time = measure(run_fast, dump)
+    assert legacy_result == fast_result, 'Rows differ'
+    _, pages, revisions = fast_result
+    print('{} pages, {} revisions, {} events, {:.1f} MB'.format(
+        pages, revisions, events, len(dump) / 1024 ** 2
+    ))
+    print('parse_xml:      {:.2f}s ({:.0f} events/s)'.format(
+        legacy_time, events / legacy_time
+    ))
+    print('fast_parse_xml: {:.2f}s ({:.0f} events/s)'.format(
+        fast_time, events / fast_time
+    ))
+    print('speedup: {:.2f}x'.format(legacy_time / fast_time))
@@ -0,0 +1,212 @@
+import argparse
+
+import numpy as np
+from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy.orm import sessionmaker
+
+from db.db_conf import get_settings
+from db.db_conf import make_engine
+from db.wiki_tables import Base
+from db.wiki_tables import Page
+from db.wiki_tables import Revision
+from dump_parse.dump_xml_parser import BulkLoader
+from dump_parse.dump_xml_parser import fast_parse_xml
+from dump_parse.dump_xml_parser import LOGGER
+from dump_parse.dump_xml_parser import open_dump
+from dump_parse.dump_xml_parser import PAGE_COLUMNS
+from dump_parse.dump_xml_parser import parse_xml
+from dump_parse.dump_xml_parser import REVISION_COLUMNS
+
+
+# Loads only revisions that aren't in the database yet, so a new
+# monthly dump (or a series of adds/changes dumps, which have the same
+# format) can be loaded on top of the previous one without reloading
+# everything. The highest revision id and its timestamp of every page
+# already in the database are kept in sorted numpy arrays, revisions
+# with lower or equal ids are skipped. Pages that are already in the
+# database aren't inserted again.
+
+PAGE_ID_INDEX = PAGE_COLUMNS.index('id')
+REVISION_ID_INDEX = REVISION_COLUMNS.index('id')
+TIMESTAMP_INDEX = REVISION_COLUMNS.index('timestamp')
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "files", nargs='+',
+        help="Dump file(s) to load in order, e.g. a monthly dump "
+             "followed by adds/changes dumps"
+    )
+    parser.add_argument(
+        "--db-url", required=True, help="Database to load the dumps into"
+    )
+    parser.add_argument(
+        "--batch-rows", type=int, default=get_settings()['batch_rows']
+    )
+    parser.add_argument(
+        "--fast", action="store_true", help="Use the fast parser"
+    )
+    return parser
+
+
+class KnownRevisions:
+    """
+    Index of the latest revision of every page in the database.
+    page_ids, last_ids and last_timestamps are arrays sorted by page
+    id, pages loaded after the index was built are kept in a dict.
+    """
+    def __init__(self, page_ids, last_ids, last_timestamps):
+        self.page_ids = page_ids
+        self.last_ids = last_ids
+        self.last_timestamps = last_timestamps
+        # page_id: (last revision id, its timestamp)
+        self.added = {}
+
+    @classmethod
+    def from_db(cls, engine):
+        # pages without revisions have to be known too
+        # so that they aren't inserted again
+        query = (
+            select([
+                Page.id, func.max(Revision.id), func.max(Revision.timestamp)
+            ])
+            .select_from(Page.__table__.outerjoin(
+                Revision.__table__, Revision.page_id == Page.id
+            ))
+            .group_by(Page.id)
+            .order_by(Page.id)
+        )
+        with engine.connect() as conn:
+            rows = conn.execute(query).fetchall()
+        page_ids = np.array([row[0] for row in rows], dtype=np.int64)
+        # pages without revisions have -1 as the last id
+        last_ids = np.array(
+            [-1 if row[1] is None else row[1] for row in rows],
+            dtype=np.int64,
+        )
+        last_timestamps = np.array(
+            [row[2] for row in rows], dtype='datetime64[s]'
+        )
+        return cls(page_ids, last_ids, last_timestamps)
+
+    def __len__(self):
+        return len(self.page_ids) + len(self.added)
+
+    def _find(self, page_id):
+        position = np.searchsorted(self.page_ids, page_id)
+        if (
+            position < len(self.page_ids)
+            and self.page_ids[position] == page_id
+        ):
+            return position
+        return None
+
+    def last_revision(self, page_id):
+        """
+        Returns (id, timestamp) of the last known revision of the page,
+        (-1, None) if it has none or None if the page isn't known.
+        """
+        if page_id in self.added:
+            return self.added[page_id]
+        position = self._find(page_id)
+        if position is None:
+            return None
+        timestamp = self.last_timestamps[position]
+        return (
+            int(self.last_ids[position]),
+            None if np.isnat(timestamp) else timestamp.item(),
+        )
+
+    def update(self, page_id, last_id, last_timestamp):
+        self.added[page_id] = (last_id, last_timestamp)
+
+    def latest_timestamp(self):
+        """Returns timestamp of the latest known revision"""
+        timestamps = [
+            timestamp for _, timestamp in self.added.values() if timestamp
+        ]
+        if len(self.last_timestamps) and not np.isnat(
+            self.last_timestamps.max()
+        ):
+            timestamps.append(self.last_timestamps.max().item())
+        return max(timestamps, default=None)
+
+
+class IncrementalLoader(BulkLoader):
+    """
+    BulkLoader that drops pages and revisions that are already in
+    the database according to known_revisions.
+    """
+    def __init__(self, engine, known_revisions, **kwargs):
+        super().__init__(engine, **kwargs)
+        self.known_revisions = known_revisions
+        self.revisions_skipped = 0
+        self.revisions_added = 0
+
+    def add_rows(self, page_row, revision_rows):
+        page_id = int(page_row[PAGE_ID_INDEX])
+        last_revision = self.known_revisions.last_revision(page_id)
+        if last_revision is not None:
+            last_id = last_revision[0]
+            new_rows = [
+                row for row in revision_rows
+                if int(row[REVISION_ID_INDEX]) > last_id
+            ]
+            self.revisions_skipped += len(revision_rows) - len(new_rows)
+            if not new_rows:
+                return
+            revision_rows = new_rows
+        if revision_rows:
+            newest = max(
+                revision_rows, key=lambda row: int(row[REVISION_ID_INDEX])
+            )
+            self.known_revisions.update(
+                page_id, int(newest[REVISION_ID_INDEX]),
+                newest[TIMESTAMP_INDEX],
+            )
+        else:
+            self.known_revisions.update(page_id, -1, None)
+        self.revisions_added += len(revision_rows)
+        super().add_rows(
+            None if last_revision is not None else page_row, revision_rows
+        )
+
+
+def load_incrementally(files, engine, batch_rows=50000, fast=False):
+    """Loads new revisions from dump files, returns the loader"""
+    known_revisions = KnownRevisions.from_db(engine)
+    LOGGER.info(
+        '%d pages in the database, the latest revision is from %s',
+        len(known_revisions), known_revisions.latest_timestamp(),
+    )
+    loader = IncrementalLoader(engine, known_revisions, max_rows=batch_rows)
+    for file_name in files:
+        with open_dump(file_name) as xml_file:
+            if fast:
+                fast_parse_xml(xml_file, loader)
+            else:
+                parse_xml(
+                    xml_file, sessionmaker(bind=engine), engine,
+                    bulk_loader=loader,
+                )
+        LOGGER.info(
+            '%s loaded: %d new revisions, %d known ones skipped',
+            file_name, loader.revisions_added, loader.revisions_skipped,
+        )
+    return loader
+
+
+if __name__ == '__main__':
+    args = get_arg_parser().parse_args()
+    engine = make_engine(args.db_url)
+    Base.metadata.create_all(engine)
+    loader = load_incrementally(
+        args.files, engine, batch_rows=args.batch_rows, fast=args.fast
+    )
+    LOGGER.info(
+        'Loaded %d revisions (%d skipped), %d pages failed',
+        loader.revisions_added, loader.revisions_skipped,
+        loader.pages_failed,
+    )
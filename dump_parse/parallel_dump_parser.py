@@ -0,0 +1,382 @@
+import argparse
+import bz2
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import as_completed
+import io
+import itertools
+import json
+import os
+from os import path
+import re
+import time
+
+from sqlalchemy.orm import sessionmaker
+
+from db.db_conf import get_settings
+from db.db_conf import make_engine
+from db.title_resolver import check_title_hash
+from db.wiki_tables import Base
+from dump_parse.dump_xml_parser import BulkLoader
+from dump_parse.dump_xml_parser import DECOMPRESSORS
+from dump_parse.dump_xml_parser import fast_parse_xml
+from dump_parse.dump_xml_parser import LOGGER
+from dump_parse.dump_xml_parser import open_dump
+from dump_parse.dump_xml_parser import parse_xml
+from dump_parse.incremental_loader import IncrementalLoader
+from dump_parse.incremental_loader import KnownRevisions
+
+
+# Parses a dump in several processes. A single dump is split into
+# byte ranges that begin at <page> tags, each range is wrapped into
+# the root element of the dump and parsed on its own. Already split
+# dumps (pages-meta-history1.xml-p1p1000 etc.) are parsed file by file.
+# bz2 multistream dumps are split on stream offsets from their index,
+# so every worker decompresses its own streams.
+# States of shards are kept in a json file so that a rerun parses only
+# shards that failed, have pages that failed or weren't parsed yet.
+# Shards that were parsed before are reparsed with IncrementalLoader,
+# so pages that are already in the database are skipped.
+
+PAGE_TAG = b'<page>'
+ROOT_END_TAG = b'</mediawiki>'
+ROOT_START_PATTERN = re.compile(rb'<mediawiki\b[^>]*>')
+SEARCH_BLOCK_SIZE = 1024 * 1024
+READ_BUFFER_SIZE = 1024 * 1024
+
+# start and end are None for shards that are whole files
+# the name has to match the type name so that shards can be pickled
+Shard = namedtuple('Shard', ['file_name', 'start', 'end'])
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs='+', help="Dump file(s) to parse")
+    parser.add_argument(
+        "--db-url", required=True, help="Database to load the dump into"
+    )
+    parser.add_argument(
+        "-s", "--shards", type=int, default=1,
+        help="Number of shards a single dump file is split into"
+    )
+    parser.add_argument(
+        "-w", "--workers", type=int, help="Number of worker processes"
+    )
+    parser.add_argument(
+        "--batch-rows", type=int, default=get_settings()['batch_rows']
+    )
+    parser.add_argument(
+        "--fast", action="store_true", help="Use the fast parser"
+    )
+    parser.add_argument(
+        "-i", "--index",
+        help="Index of a bz2 multistream dump, it's split on its streams"
+    )
+    parser.add_argument(
+        "--state-file", default='shards.json',
+        help="Where states of shards are kept between reruns"
+    )
+    return parser
+
+
+def shard_key(shard):
+    if shard.start is None:
+        return shard.file_name
+    return '{}:{}-{}'.format(shard.file_name, shard.start, shard.end)
+
+
+def find_forward(file_, offset, pattern):
+    """Returns offset of the first occurrence of pattern after offset"""
+    file_.seek(offset)
+    # keep the tail of the previous block in case the
+    # pattern is split between two blocks
+    tail = b''
+    while True:
+        block = file_.read(SEARCH_BLOCK_SIZE)
+        if not block:
+            return None
+        found = (tail + block).find(pattern)
+        if found != -1:
+            return offset - len(tail) + found
+        offset += len(block)
+        tail = block[-len(pattern) + 1:]
+
+
+def split_by_pages(file_name, shards):
+    """
+    Splits dump into at most 'shards' ranges that begin at <page>
+    tags. The last one ends at the closing tag of the root element.
+    """
+    size = path.getsize(file_name)
+    with open(file_name, 'rb') as dump_file:
+        starts = []
+        for i in range(shards):
+            offset = size * i // shards
+            if starts:
+                offset = max(offset, starts[-1] + 1)
+            start = find_forward(dump_file, offset, PAGE_TAG)
+            if start is None:
+                break
+            starts.append(start)
+        # the closing root tag is somewhere at the very end
+        tail_start = max(size - SEARCH_BLOCK_SIZE, 0)
+        dump_file.seek(tail_start)
+        end = tail_start + dump_file.read().rfind(ROOT_END_TAG)
+    return [
+        Shard(file_name, start, shard_end)
+        for start, shard_end in zip(starts, starts[1:] + [end])
+    ]
+
+
+def read_multistream_offsets(index_file):
+    """
+    Returns sorted offsets of streams with pages from the index of a
+    multistream dump (its lines are offset:page_id:title).
+    """
+    with bz2.open(index_file, 'rb') as index:
+        return sorted({int(line.split(b':', 1)[0]) for line in index})
+
+
+def find_stream_end(file_name, offset):
+    """Returns offset right after the bz2 stream that begins at offset"""
+    decompressor = bz2.BZ2Decompressor()
+    with open(file_name, 'rb') as dump_file:
+        dump_file.seek(offset)
+        while not decompressor.eof:
+            data = dump_file.read(SEARCH_BLOCK_SIZE)
+            if not data:
+                return offset
+            decompressor.decompress(data)
+            offset += len(data)
+    return offset - len(decompressor.unused_data)
+
+
+def split_multistream(file_name, index_file, shards):
+    """
+    Splits multistream dump into at most 'shards' ranges of whole
+    streams with pages. The header and footer streams are left out.
+    """
+    offsets = read_multistream_offsets(index_file)
+    offsets.append(find_stream_end(file_name, offsets[-1]))
+    streams = len(offsets) - 1
+    bounds = sorted({streams * i // shards for i in range(shards)})
+    return [
+        Shard(file_name, offsets[first], offsets[last])
+        for first, last in zip(bounds, bounds[1:] + [streams])
+    ]
+
+
+def read_root_start_tag(file_name):
+    """Returns opening tag of the root element (with namespaces)"""
+    with open_dump(file_name) as dump_file:
+        head = dump_file.read(SEARCH_BLOCK_SIZE)
+    return ROOT_START_PATTERN.search(head).group(0)
+
+
+def iter_range_chunks(file_name, start, end):
+    with open(file_name, 'rb') as dump_file:
+        dump_file.seek(start)
+        left = end - start
+        while left:
+            chunk = dump_file.read(min(READ_BUFFER_SIZE, left))
+            if not chunk:
+                return
+            left -= len(chunk)
+            yield chunk
+
+
+def iter_multistream_chunks(file_name, start, end):
+    """Yields decompressed data of bz2 streams in a byte range"""
+    decompressor = bz2.BZ2Decompressor()
+    for data in iter_range_chunks(file_name, start, end):
+        while data:
+            yield decompressor.decompress(data)
+            if decompressor.eof:
+                data = decompressor.unused_data
+                decompressor = bz2.BZ2Decompressor()
+            else:
+                data = b''
+
+
+class ChunksReader(io.RawIOBase):
+    """Raw stream over an iterable of bytes chunks"""
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.pending = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.pending = memoryview(chunk)
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+
+def open_shard(shard):
+    """
+    Returns a file-like object with the shard's part of the dump
+    wrapped into the root element so that it's a well-formed document.
+    """
+    if shard.file_name.endswith('.bz2'):
+        chunks = iter_multistream_chunks(*shard)
+    else:
+        chunks = iter_range_chunks(*shard)
+    wrapped_chunks = itertools.chain(
+        [read_root_start_tag(shard.file_name)], chunks, [ROOT_END_TAG]
+    )
+    return io.BufferedReader(
+        ChunksReader(wrapped_chunks), buffer_size=READ_BUFFER_SIZE
+    )
+
+
+def parse_shard(shard, db_url, batch_rows, fast=False, known_revisions=None):
+    """
+    Runs in a worker process, returns (shard, pages loaded,
+    pages failed, seconds spent). Progress is logged after every
+    batch. Reruns get known_revisions (a KnownRevisions of the
+    database) and skip revisions that are in the database already.
+    """
+    started_at = time.monotonic()
+    engine = make_engine(db_url)
+
+    def log_progress(loader):
+        LOGGER.info(
+            'Shard %s: %d pages loaded, %d failed so far, %.0fs',
+            shard_key(shard), loader.pages_loaded, loader.pages_failed,
+            time.monotonic() - started_at,
+        )
+
+    if known_revisions is not None:
+        bulk_loader = IncrementalLoader(
+            engine, known_revisions, max_rows=batch_rows,
+            on_flush=log_progress,
+        )
+    else:
+        bulk_loader = BulkLoader(
+            engine, max_rows=batch_rows, on_flush=log_progress
+        )
+    if shard.start is None:
+        dump_context = open_dump(shard.file_name)
+    else:
+        dump_context = open_shard(shard)
+    try:
+        with dump_context as xml_file:
+            if fast:
+                fast_parse_xml(xml_file, bulk_loader)
+            else:
+                parse_xml(
+                    xml_file, sessionmaker(bind=engine), engine,
+                    bulk_loader=bulk_loader,
+                )
+    finally:
+        engine.dispose()
+    return (
+        shard, bulk_loader.pages_loaded, bulk_loader.pages_failed,
+        time.monotonic() - started_at,
+    )
+
+
+def load_states(state_file):
+    if not path.exists(state_file):
+        return {}
+    with open(state_file) as file_:
+        return json.load(file_)
+
+
+def save_states(state_file, states):
+    tmp_file = state_file + '.tmp'
+    with open(tmp_file, 'w') as file_:
+        json.dump(states, file_, indent=2)
+    os.replace(tmp_file, state_file)
+
+
+def generate_shards(files, shards_per_file, index_file=None):
+    for file_name in files:
+        if index_file:
+            yield from split_multistream(
+                file_name, index_file, shards_per_file
+            )
+        elif shards_per_file == 1 or (
+            path.splitext(file_name)[1] in DECOMPRESSORS
+        ):
+            # compressed dumps without an index can't be split
+            yield Shard(file_name, None, None)
+        else:
+            yield from split_by_pages(file_name, shards_per_file)
+
+
+def parse_in_parallel(shards, db_url, state_file, workers=None,
+                      batch_rows=50000, fast=False):
+    """
+    Parses shards that aren't marked as done in state_file in a pool
+    of worker processes. Returns keys of shards that failed or have
+    pages that failed.
+    """
+    states = load_states(state_file)
+    todo = [
+        shard for shard in shards
+        if states.get(shard_key(shard), {}).get('status') != 'done'
+    ]
+    LOGGER.info('%d of %d shards to parse', len(todo), len(shards))
+    engine = make_engine(db_url)
+    Base.metadata.create_all(engine)
+    check_title_hash(engine)
+    known_revisions = None
+    if any(shard_key(shard) in states for shard in todo):
+        # read once for all reruns, it's a GROUP BY over all revisions
+        known_revisions = KnownRevisions.from_db(engine)
+    engine.dispose()
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                parse_shard, shard, db_url, batch_rows, fast,
+                known_revisions if shard_key(shard) in states else None,
+            ): shard
+            for shard in todo
+        }
+        for done_counter, future in enumerate(as_completed(futures), 1):
+            shard = futures[future]
+            key = shard_key(shard)
+            try:
+                _, pages_loaded, pages_failed, seconds = future.result()
+                status = 'done' if pages_failed == 0 else 'incomplete'
+                states[key] = {
+                    'status': status, 'pages_loaded': pages_loaded,
+                    'pages_failed': pages_failed, 'seconds': seconds,
+                }
+                if pages_failed:
+                    failed.append(key)
+                LOGGER.info(
+                    'Shard %s %s (%d/%d): %d pages, %d failed, %.0fs',
+                    key, status, done_counter, len(todo), pages_loaded,
+                    pages_failed, seconds,
+                )
+            except Exception:
+                states[key] = {'status': 'failed'}
+                failed.append(key)
+                LOGGER.exception('Shard %s failed', key)
+            save_states(state_file, states)
+    return failed
+
+
+if __name__ == '__main__':
+    args = get_arg_parser().parse_args()
+    failed = parse_in_parallel(
+        list(generate_shards(args.files, args.shards, args.index)),
+        args.db_url,
+        args.state_file, workers=args.workers, batch_rows=args.batch_rows,
+        fast=args.fast,
+    )
+    if failed:
+        LOGGER.error(
+            '%d shards failed or have failed pages, rerun to retry them',
+            len(failed),
+        )
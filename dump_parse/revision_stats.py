@@ -0,0 +1,158 @@
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
+import hashlib
+import logging
+import os
+import re
+
+from db.wiki_tables import RevisionStats
+
+
+# Statistics of revision texts computed while the dump is parsed, so
+# the text doesn't have to be read again later. The parser hands texts
+# of pages to RevisionStatsExtractor which sends them to worker
+# processes in batches and inserts the stats they return. Texts of
+# pages with long histories are handed over in parts, with the size of
+# the last revision of a part passed along so that the size delta of
+# the next revision can be computed.
+
+LOGGER = logging.getLogger('xml-parser')
+STATS_COLUMNS = tuple(RevisionStats.__table__.columns.keys())
+# target of a wiki link, up to the label or section
+LINK_PATTERN = re.compile(r'\[\[\s*([^\[\]|#]*)')
+# template calls, but not {{{parameters}}}
+TEMPLATE_PATTERN = re.compile(r'(?<!\{)\{\{(?!\{)')
+CATEGORY_PREFIXES = ('категорія:', 'category:')
+
+
+def count_links(text):
+    """Returns (links, categories) in wiki text"""
+    links = categories = 0
+    for target in LINK_PATTERN.findall(text):
+        if target.lower().startswith(CATEGORY_PREFIXES):
+            categories += 1
+        else:
+            links += 1
+    return links, categories
+
+
+def extract_stats(pages):
+    """
+    Runs in a worker process. pages is a list of (page_id, revisions,
+    parent_sizes) where revisions are (id, parentid, text) of the page
+    (or its part) and parent_sizes are {id: byte size} of revisions
+    from its previous part. Returns rows of revision_stats as tuples
+    in the order of STATS_COLUMNS.
+    """
+    rows = []
+    for page_id, revisions, parent_sizes in pages:
+        sizes = dict(parent_sizes)
+        for revision_id, parentid, text in revisions:
+            data = (text or '').encode('utf-8')
+            sizes[revision_id] = len(data)
+            parent_size = sizes.get(parentid)
+            links, categories = count_links(text or '')
+            values = {
+                'revision_id': revision_id,
+                'page_id': page_id,
+                'byte_size': len(data),
+                'size_delta': (
+                    None if parent_size is None else len(data) - parent_size
+                ),
+                'links': links,
+                'categories': categories,
+                'templates': len(TEMPLATE_PATTERN.findall(text or '')),
+                'sha1': hashlib.sha1(data).hexdigest(),
+            }
+            rows.append(tuple(values[column] for column in STATS_COLUMNS))
+    return rows
+
+
+class RevisionStatsExtractor:
+    """
+    Collects texts of pages and computes their stats in a pool of
+    worker processes, batch_bytes of text per task. At most
+    max_pending tasks are in flight, add blocks when there are more.
+    Stats are inserted into revision_stats with executemany as tasks
+    complete.
+    """
+    def __init__(self, engine, workers=None, batch_bytes=16 * 1024 ** 2,
+                 max_pending=None):
+        self.engine = engine
+        self.batch_bytes = batch_bytes
+        workers = workers or os.cpu_count()
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.max_pending = max_pending or 2 * workers
+        self.pending = set()
+        self.revisions_done = 0
+        # page id and {id: byte size} of the last revision of a part
+        # of a page whose other revisions are still to come
+        self.unfinished_page = None
+        self.unfinished_sizes = {}
+        self._reset()
+
+    def _reset(self):
+        self.pages = []
+        self.bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, page_id, revisions, more=False):
+        """
+        Adds (id, parentid, text) of revisions of a page, more=True
+        means that the rest of its revisions are added later
+        """
+        parent_sizes = (
+            self.unfinished_sizes if page_id == self.unfinished_page else {}
+        )
+        self.pages.append((page_id, revisions, parent_sizes))
+        self.bytes += sum(len(text or '') for _, _, text in revisions)
+        if more and revisions:
+            revision_id, _, text = revisions[-1]
+            self.unfinished_page = page_id
+            self.unfinished_sizes = {
+                revision_id: len((text or '').encode('utf-8'))
+            }
+        else:
+            self.unfinished_page = None
+            self.unfinished_sizes = {}
+        if self.bytes >= self.batch_bytes:
+            self.submit()
+
+    def submit(self):
+        if not self.pages:
+            return
+        while len(self.pending) >= self.max_pending:
+            done, self.pending = wait(
+                self.pending, return_when=FIRST_COMPLETED
+            )
+            self._insert(done)
+        self.pending.add(self.executor.submit(extract_stats, self.pages))
+        self._reset()
+
+    def _insert(self, futures):
+        rows = [row for future in futures for row in future.result()]
+        if not rows:
+            return
+        with self.engine.begin() as conn:
+            conn.execute(
+                RevisionStats.__table__.insert(),
+                [dict(zip(STATS_COLUMNS, row)) for row in rows]
+            )
+        self.revisions_done += len(rows)
+        LOGGER.info('Stats of %d revisions saved', self.revisions_done)
+
+    def close(self):
+        """Waits for all tasks and saves their stats"""
+        try:
+            self.submit()
+            done, _ = wait(self.pending)
+            self.pending = set()
+            self._insert(done)
+        finally:
+            self.executor.shutdown()
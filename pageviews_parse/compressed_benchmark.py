@@ -0,0 +1,68 @@
+"""
+Compares parsing a compressed pagecount file by streaming it through
+a decompressor with decompressing it to disk first and parsing after.
+
+    python -m pageviews_parse.compressed_benchmark \
+        pagecounts-2011-12-views-ge-5.bz2 2011 12 -p uk.z
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from pageviews_parse.pageview_data_downloader import PagecountFileParser
+from pageviews_parse.pageview_data_downloader import open_compressed
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("file_name", help="gz or bz2 pagecount file")
+    parser.add_argument("year", type=int)
+    parser.add_argument("month", type=int)
+    parser.add_argument("-p", "--project", default='uk.z')
+    parser.add_argument(
+        "-d", "--tmp-dir", help="Where to decompress the file to"
+    )
+    return parser
+
+
+def count_parsed(parser):
+    return sum(1 for _ in parser.parse_days())
+
+
+def parse_decompressed(file_name, year, month, project, tmp_dir=None):
+    """Old way: decompress to a temporary file and parse it"""
+    with tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False) as tmp_file:
+        with open_compressed(file_name) as compressed_file:
+            shutil.copyfileobj(compressed_file, tmp_file)
+    try:
+        return count_parsed(
+            PagecountFileParser(year, month, tmp_file.name, project)
+        )
+    finally:
+        os.remove(tmp_file.name)
+
+
+def parse_streamed(file_name, year, month, project):
+    return count_parsed(PagecountFileParser(year, month, file_name, project))
+
+
+def measure(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    args = get_arg_parser().parse_args()
+    file_args = args.file_name, args.year, args.month, args.project
+    lines, decompressed_time = measure(
+        parse_decompressed, *file_args, tmp_dir=args.tmp_dir
+    )
+    streamed_lines, streamed_time = measure(parse_streamed, *file_args)
+    assert lines == streamed_lines
+    print('Parsed {} lines'.format(lines))
+    print('decompress then parse: {:.2f}s'.format(decompressed_time))
+    print('streaming parse:       {:.2f}s'.format(streamed_time))
+    print('speedup: {:.2f}x'.format(decompressed_time / streamed_time))
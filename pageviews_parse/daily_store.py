@@ -0,0 +1,184 @@
+import argparse
+from calendar import monthrange
+from datetime import date
+import json
+import os
+from os import path
+
+import numpy as np
+
+from common.arrays import save_array
+from pageviews_parse.pageview_data_downloader import PagecountFileParser
+
+
+# Parsed daily pageviews stored on disk so that analyses don't have
+# to re-parse raw pagecount files. The store is a directory with
+#   titles.jsonl           - title dictionary, title id is its line number
+#   YYYY-MM.ids.npy        - sorted int32 ids of titles present in a month
+#   YYYY-MM.views.npy      - int32 (titles x days) matrix of daily views
+# Month matrices are memory-mapped when read. Days without views are 0.
+
+TITLES_FILE = 'titles.jsonl'
+IDS_SUFFIX = '.ids.npy'
+VIEWS_SUFFIX = '.views.npy'
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("store_dir")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    add_parser = subparsers.add_parser('add', help="Add a pagecount file")
+    add_parser.add_argument("file_name")
+    add_parser.add_argument("year", type=int)
+    add_parser.add_argument("month", type=int)
+    add_parser.add_argument("-p", "--project", default='uk.z')
+    top_parser = subparsers.add_parser('top', help="Print most viewed titles")
+    top_parser.add_argument("n", type=int)
+    return parser
+
+
+def month_key(year, month):
+    return '{:04d}-{:02d}'.format(year, month)
+
+
+class DailyViewsStore:
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        os.makedirs(store_dir, exist_ok=True)
+        self.titles = []
+        self.title_ids = {}
+        titles_path = path.join(store_dir, TITLES_FILE)
+        if path.exists(titles_path):
+            with open(titles_path, encoding='utf-8') as titles_file:
+                for line in titles_file:
+                    self._add_title(json.loads(line))
+
+    def _add_title(self, title):
+        self.title_ids[title] = len(self.titles)
+        self.titles.append(title)
+        return self.title_ids[title]
+
+    def _month_path(self, year, month, suffix):
+        return path.join(self.store_dir, month_key(year, month) + suffix)
+
+    def months(self):
+        """Returns sorted (year, month) tuples of stored months"""
+        return sorted(
+            tuple(map(int, file_name[:-len(IDS_SUFFIX)].split('-')))
+            for file_name in os.listdir(self.store_dir)
+            if file_name.endswith(IDS_SUFFIX)
+        )
+
+    def add_month(self, year, month, titles_days):
+        """
+        Stores a month given an iterable of (title, days) pairs as
+        yielded by PagecountFileParser.parse_days. Views of titles
+        that occur several times are summed.
+        """
+        new_titles = []
+        ids = []
+        rows = []
+        for title, days in titles_days:
+            if title not in self.title_ids:
+                self._add_title(title)
+                new_titles.append(title)
+            ids.append(self.title_ids[title])
+            rows.append(days)
+        # the dictionary goes first so that month files
+        # never refer to ids that aren't saved
+        with open(path.join(self.store_dir, TITLES_FILE), 'a',
+                  encoding='utf-8') as titles_file:
+            titles_file.writelines(
+                json.dumps(title, ensure_ascii=False) + '\n'
+                for title in new_titles
+            )
+        days_in_month = monthrange(year, month)[1]
+        if rows:
+            views = np.clip(np.vstack(rows), 0, None)
+        else:
+            views = np.empty((0, days_in_month), dtype=np.int64)
+        ids = np.array(ids, dtype=np.int32)
+        order = np.argsort(ids, kind='stable')
+        unique_ids, starts = np.unique(ids[order], return_index=True)
+        if len(ids):
+            views = np.add.reduceat(views[order], starts, axis=0)
+        save_array(
+            self._month_path(year, month, VIEWS_SUFFIX),
+            views.astype(np.int32),
+        )
+        save_array(self._month_path(year, month, IDS_SUFFIX), unique_ids)
+
+    def load_month(self, year, month):
+        """Returns memory-mapped (ids, views) arrays of a month"""
+        return (
+            np.load(self._month_path(year, month, IDS_SUFFIX), mmap_mode='r'),
+            np.load(
+                self._month_path(year, month, VIEWS_SUFFIX), mmap_mode='r'
+            ),
+        )
+
+    def get_series(self, title):
+        """
+        Returns (dates, views) arrays with daily views of the title
+        over all stored months, dates being datetime64[D].
+        """
+        title_id = self.title_ids.get(title)
+        dates = []
+        views = []
+        for year, month in self.months():
+            month_dates = np.arange(
+                np.datetime64(date(year, month, 1)),
+                np.datetime64(date(year, month, monthrange(year, month)[1]))
+                + 1,
+            )
+            dates.append(month_dates)
+            month_series = np.zeros(len(month_dates), dtype=np.int64)
+            ids, month_views = self.load_month(year, month)
+            if title_id is not None:
+                row = np.searchsorted(ids, title_id)
+                if row < len(ids) and ids[row] == title_id:
+                    month_series[:] = month_views[row]
+            views.append(month_series)
+        if not dates:
+            return np.array([], 'datetime64[D]'), np.array([], np.int64)
+        return np.concatenate(dates), np.concatenate(views)
+
+    def total_views(self, start=None, end=None):
+        """
+        Returns an array of total views by title id for stored days
+        between start and end dates (inclusive, both optional).
+        """
+        totals = np.zeros(len(self.titles), dtype=np.int64)
+        for year, month in self.months():
+            first_day = date(year, month, 1)
+            last_day = date(year, month, monthrange(year, month)[1])
+            if (start and last_day < start) or (end and first_day > end):
+                continue
+            from_day = start.day - 1 if start and start > first_day else 0
+            to_day = end.day if end and end < last_day else last_day.day
+            ids, views = self.load_month(year, month)
+            totals[ids] += views[:, from_day:to_day].sum(
+                axis=1, dtype=np.int64
+            )
+        return totals
+
+    def top_n(self, n, start=None, end=None):
+        """Returns [(title, views)] of the n most viewed titles"""
+        totals = self.total_views(start, end)
+        n = min(n, len(totals))
+        top_ids = np.argpartition(-totals, n - 1)[:n] if n else []
+        top_ids = sorted(top_ids, key=lambda id_: -totals[id_])
+        return [(self.titles[id_], int(totals[id_])) for id_ in top_ids]
+
+
+if __name__ == '__main__':
+    args = get_arg_parser().parse_args()
+    store = DailyViewsStore(args.store_dir)
+    if args.command == 'add':
+        parser = PagecountFileParser(
+            args.year, args.month, args.file_name, args.project
+        )
+        store.add_month(args.year, args.month, parser.parse_days())
+    else:
+        for title, views in store.top_n(args.n):
+            print(views, title)
@@ -0,0 +1,303 @@
+import calendar
+from datetime import datetime
+from functools import lru_cache
+import logging
+import queue
+import threading
+import time
+
+from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBClientError
+
+from pageviews_parse.metrics import disabled_metrics
+
+logger = logging.getLogger('wiki')
+
+INFLUX_HOST = 'localhost'
+INFLUX_PORT = 8086
+INFLUX_DATABASE = 'wiki_pageviews'
+MEASUREMENT = 'page_views'
+
+
+# Line protocol helpers
+
+
+def escape_tag(value):
+    """Escapes tag key or value for InfluxDB line protocol"""
+    return (
+        value.replace('\\', '\\\\')
+        .replace(' ', '\\ ')
+        .replace(',', '\\,')
+        .replace('=', '\\=')
+        .replace('\n', '\\n')
+    )
+
+
+@lru_cache(maxsize=4096)
+def to_epoch_seconds(time_):
+    """
+    Accepts ISO string (as returned by PagecountFileParser.parse)
+    or datetime, naive ones are treated as UTC.
+    """
+    if isinstance(time_, str):
+        time_ = datetime.fromisoformat(time_)
+    return calendar.timegm(time_.utctimetuple())
+
+
+def encode_line(measurement, tags, value, time_):
+    """Encodes a single integer point, tags should be already escaped"""
+    return '{measurement}{tags} value={value}i {time}'.format(
+        measurement=measurement, tags=tags, value=value,
+        time=to_epoch_seconds(time_),
+    )
+
+
+class InfluxBatchWriter:
+    """
+    Buffers page views as line protocol strings and writes them to
+    InfluxDB in batches from a background thread.
+
+    A batch is sent once it has batch_size points or flush_interval
+    seconds have passed since its first point. At most max_pending
+    batches wait to be written, after that write() blocks until the
+    background thread catches up. Failed batches are retried 'retries'
+    times with exponential backoff and dropped (and logged) after that.
+    Client errors (4xx) aren't retried. A batch with lines InfluxDB
+    can't parse is split in halves until the bad lines are found, they
+    are logged, counted in points_rejected and appended to
+    rejected_file if it's given, the rest of the batch is written.
+
+    Usage:
+        with InfluxBatchWriter() as writer:
+            for title, view_counts in parser.parse():
+                writer.write(title, view_counts)
+    """
+    def __init__(self, host=INFLUX_HOST, port=INFLUX_PORT,
+                 database=INFLUX_DATABASE, measurement=MEASUREMENT,
+                 batch_size=5000, flush_interval=1.0, max_pending=10,
+                 retries=3, retry_delay=1.0, report_interval=60.0,
+                 client=None, metrics=disabled_metrics,
+                 retention_policy=None, rejected_file=None):
+        self.client = client or InfluxDBClient(host, port, database=database)
+        self.measurement = escape_tag(measurement)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.report_interval = report_interval
+        self.metrics = metrics
+        self.retention_policy = retention_policy
+        self.rejected_file = rejected_file
+
+        self.points_written = 0
+        self.points_dropped = 0
+        self.points_rejected = 0
+        self.titles_skipped = 0
+        self.failed_batches = 0
+        self.started_at = None
+        self.last_report_at = None
+
+        self._buffer = []
+        self._buffer_started_at = None
+        self._lock = threading.Lock()
+        # held while the background thread writes out an expired buffer
+        self._expired_lock = threading.Lock()
+        self._batches = queue.Queue(maxsize=max_pending)
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def start(self):
+        self.started_at = self.last_report_at = time.monotonic()
+        self._thread = threading.Thread(
+            target=self._write_batches, name='influx-writer', daemon=True
+        )
+        self._thread.start()
+
+    def write(self, title, view_counts, tags=None):
+        """
+        Adds points for a title. view_counts is a dict of times
+        (ISO strings or datetimes) to views, None views are skipped.
+        Titles that are empty (e.g. '%20' decoded and stripped) can't
+        be written and are skipped.
+        """
+        if not title:
+            self.titles_skipped += 1
+            self.metrics.count('titles_skipped')
+            logger.warning('Skipped points of an empty title')
+            return
+        tags = dict(tags or {}, title=title)
+        # empty tag values are invalid in line protocol
+        encoded_tags = ''.join(
+            ',{}={}'.format(escape_tag(key), escape_tag(str(value)))
+            for key, value in sorted(tags.items()) if str(value)
+        )
+        lines = [
+            encode_line(self.measurement, encoded_tags, value, time_)
+            for time_, value in view_counts.items() if value is not None
+        ]
+        self.write_lines(lines)
+
+    def write_lines(self, lines):
+        """Adds already encoded line protocol strings"""
+        if self._thread is None:
+            self.start()
+        batches = []
+        with self._lock:
+            if not self._buffer:
+                self._buffer_started_at = time.monotonic()
+            self._buffer.extend(lines)
+            while len(self._buffer) >= self.batch_size:
+                batches.append(self._buffer[:self.batch_size])
+                del self._buffer[:self.batch_size]
+        # put outside the lock so that the background thread
+        # can flush the buffer while we're blocked on a full queue
+        for batch in batches:
+            self._batches.put(batch)
+
+    def flush(self):
+        """Sends out whatever is in the buffer"""
+        with self._lock:
+            batch, self._buffer = self._buffer, []
+        if batch:
+            self._batches.put(batch)
+
+    def wait(self):
+        """
+        Flushes the buffer and blocks until every point written so
+        far is either in the database or dropped.
+        """
+        self.flush()
+        self._batches.join()
+        with self._expired_lock:
+            pass
+
+    def close(self):
+        if self._thread is None:
+            return
+        self.flush()
+        self._batches.put(None)
+        self._thread.join()
+        self._thread = None
+        self.report()
+
+    @property
+    def points_per_second(self):
+        if self.started_at is None:
+            return 0.0
+        elapsed = time.monotonic() - self.started_at
+        return self.points_written / elapsed if elapsed else 0.0
+
+    def report(self):
+        logger.info(
+            'Influx writer: %d points written (%.0f points/sec), '
+            '%d failed batches, %d points dropped, %d points rejected',
+            self.points_written, self.points_per_second,
+            self.failed_batches, self.points_dropped, self.points_rejected,
+        )
+        self.last_report_at = time.monotonic()
+
+    def _write_batches(self):
+        while True:
+            try:
+                batch = self._batches.get(timeout=self.flush_interval)
+            except queue.Empty:
+                self._flush_if_expired()
+                continue
+            if batch is None:
+                self._batches.task_done()
+                return
+            self._write_batch(batch)
+            self._batches.task_done()
+            self._flush_if_expired()
+            if time.monotonic() - self.last_report_at >= self.report_interval:
+                self.report()
+
+    def _flush_if_expired(self):
+        with self._expired_lock:
+            with self._lock:
+                expired = (
+                    self._buffer and
+                    time.monotonic() - self._buffer_started_at >=
+                    self.flush_interval
+                )
+                if not expired:
+                    return
+                batch, self._buffer = self._buffer, []
+            # the queue can be full but this thread is the only consumer
+            # so write the batch right away instead of putting it there
+            self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        for attempt in range(self.retries + 1):
+            try:
+                with self.metrics.timed('influx_write'):
+                    self.client.write_points(
+                        batch, time_precision='s', protocol='line',
+                        retention_policy=self.retention_policy,
+                    )
+                self.points_written += len(batch)
+                self.metrics.count('points_written', len(batch))
+                return
+            except InfluxDBClientError as error:
+                self.metrics.count('write_errors')
+                if error.code is not None and 400 <= error.code < 500:
+                    # retrying can't help here
+                    if is_rejected_line_error(error):
+                        self._write_rejected(batch, error)
+                    else:
+                        self._drop_batch(batch)
+                    return
+                if not self._wait_for_retry(batch, attempt):
+                    return
+            except Exception:
+                self.metrics.count('write_errors')
+                if not self._wait_for_retry(batch, attempt):
+                    return
+
+    def _wait_for_retry(self, batch, attempt):
+        """
+        Sleeps before the next attempt to write a batch that failed,
+        or drops it and returns False if it was the last attempt
+        """
+        if attempt == self.retries:
+            self._drop_batch(batch)
+            return False
+        logger.warning(
+            'Failed to write batch of %d points, retrying',
+            len(batch), exc_info=True,
+        )
+        time.sleep(self.retry_delay * 2 ** attempt)
+        return True
+
+    def _drop_batch(self, batch):
+        self.failed_batches += 1
+        self.points_dropped += len(batch)
+        logger.exception('Dropped batch of %d points', len(batch))
+
+    def _write_rejected(self, batch, error):
+        """Writes halves of a batch with bad lines down to single lines"""
+        if len(batch) > 1:
+            middle = len(batch) // 2
+            self._write_batch(batch[:middle])
+            self._write_batch(batch[middle:])
+            return
+        self.points_rejected += 1
+        self.metrics.count('points_rejected')
+        logger.error('InfluxDB rejected %r: %s', batch[0], error.content)
+        if self.rejected_file:
+            with open(self.rejected_file, 'a', encoding='utf-8') as file_:
+                file_.write(batch[0] + '\n')
+
+
+def is_rejected_line_error(error):
+    """True if InfluxDB refused some lines of a write, not the write"""
+    content = error.content or ''
+    return error.code == 400 and (
+        'unable to parse' in content or 'partial write' in content
+    )
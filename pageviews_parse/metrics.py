@@ -0,0 +1,114 @@
+from collections import Counter
+from collections import defaultdict
+from contextlib import nullcontext
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger('wiki')
+
+
+class StageTimer:
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.metrics.add_time(
+            self.stage, time.perf_counter() - self.started_at
+        )
+
+
+class PipelineMetrics:
+    """
+    Counters and per-stage timings of the pagecount pipeline.
+
+    Disabled metrics (the default for parsers and writers) do nothing,
+    so the hot loops pay only for a method call. Enabled ones track
+    lines scanned and matched, bytes read, errors, time spent in
+    parse_line, parse_visits, aggregate_days and influx_write, log a
+    summary every report_interval seconds and can be dumped as JSON.
+    """
+    def __init__(self, enabled=True, report_interval=60.0):
+        self.enabled = enabled
+        self.report_interval = report_interval
+        self.counters = Counter()
+        self.stage_seconds = defaultdict(float)
+        self.stage_calls = Counter()
+        self.started_at = self.last_report_at = time.monotonic()
+        # the influx writer reports from its own thread
+        self._lock = threading.Lock()
+        self._null_timer = nullcontext()
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] += value
+
+    def counted(self, items, name, bytes_name=None):
+        """Yields items counting them (and their lengths if bytes_name)"""
+        if not self.enabled:
+            yield from items
+            return
+        count = size = 0
+        try:
+            for item in items:
+                count += 1
+                if bytes_name:
+                    size += len(item)
+                yield item
+        finally:
+            self.count(name, count)
+            if bytes_name:
+                self.count(bytes_name, size)
+
+    def timed(self, stage):
+        if not self.enabled:
+            return self._null_timer
+        return StageTimer(self, stage)
+
+    def add_time(self, stage, seconds):
+        with self._lock:
+            self.stage_seconds[stage] += seconds
+            self.stage_calls[stage] += 1
+
+    def maybe_report(self):
+        if not self.enabled:
+            return
+        if time.monotonic() - self.last_report_at >= self.report_interval:
+            self.report()
+
+    def report(self):
+        self.last_report_at = time.monotonic()
+        logger.info('Pipeline metrics: %s', json.dumps(self.as_dict()))
+
+    def as_dict(self):
+        with self._lock:
+            elapsed = time.monotonic() - self.started_at
+            return {
+                'elapsed_seconds': elapsed,
+                'counters': dict(self.counters),
+                'lines_matched_per_second': (
+                    self.counters['lines_matched'] / elapsed if elapsed else 0
+                ),
+                'stages': {
+                    stage: {
+                        'seconds': seconds,
+                        'calls': self.stage_calls[stage],
+                    }
+                    for stage, seconds in self.stage_seconds.items()
+                },
+            }
+
+    def dump(self, file_name):
+        with open(file_name, 'w') as file_:
+            json.dump(self.as_dict(), file_, indent=2)
+
+
+# used by everything that wasn't given metrics explicitly
+disabled_metrics = PipelineMetrics(enabled=False)
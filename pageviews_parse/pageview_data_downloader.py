@@ -1,10 +1,15 @@
+import bz2
 from calendar import monthrange
 import codecs
 from collections import namedtuple
 from datetime import datetime
+from functools import lru_cache
 from functools import partial
+import gzip
 from itertools import groupby
 import logging
+import mmap
+from os import path
 from pprint import pprint
 from operator import attrgetter
 from operator import itemgetter
@@ -12,9 +17,32 @@ import re
 from urllib import parse
 
 from fn import F
-from influxdb import InfluxDBClient
+import numpy as np
+
+from common import compressed
+from pageviews_parse.influx_writer import InfluxBatchWriter
+from pageviews_parse.metrics import disabled_metrics
+from pageviews_parse.metrics import PipelineMetrics
 
 BASE_URL = 'https://dumps.wikimedia.org/other/pagecounts-raw/'
+# extension: (external decompressor commands in order of preference,
+# python fallback), see common.compressed
+DECOMPRESSORS = {
+    '.gz': ((['pigz', '-dc'], ['gzip', '-dc']), gzip.open),
+    '.bz2': (
+        (['lbzip2', '-dc'], ['pbzip2', '-dc'], ['bzip2', '-dc']), bz2.open
+    ),
+}
+TITLE_CACHE_SIZE = 2 ** 18
+# resolution: (retention policy, its duration), days go to the default
+# policy (None) like the points of load_pageviews_to_influx and other
+# loaders that write daily views
+RESOLUTION_TIERS = {
+    'hour': ('hourly', '90d'),
+    'day': (None, None),
+    'week': ('weekly', 'INF'),
+    'month': ('monthly', 'INF'),
+}
 logger = logging.getLogger('wiki')
 logger.setLevel(logging.INFO)
 handler = logging.FileHandler('log.log')
@@ -47,6 +75,39 @@ def apply_to_vals(dct, func):
     return {key: func(val) for key, val in dct.items()}
 
 
+def unquote_title(title):
+    # titles are sometimes at least double quoted
+    prev_title = ''
+    while title != prev_title:
+        title, prev_title = parse.unquote_plus(title).strip(), title
+    return title
+
+
+def make_title_cache(maxsize=TITLE_CACHE_SIZE):
+    """
+    Returns LRU memoized unquote_title. Its cache_info() gives
+    hit and miss counters to tune the size.
+    """
+    return lru_cache(maxsize=maxsize)(unquote_title)
+
+
+# shared by all parsers in the process so that titles that recur
+# every month are decoded only once per run
+title_cache = make_title_cache()
+
+
+def is_compressed(file_name):
+    return path.splitext(file_name)[1] in DECOMPRESSORS
+
+
+def open_compressed(file_name, use_external=True):
+    """
+    Opens file for binary reading, gz and bz2 files are decompressed
+    on the fly (see common.compressed.open_compressed).
+    """
+    return compressed.open_compressed(file_name, DECOMPRESSORS, use_external)
+
+
 class PagecountFileParser:
     line_parts = namedtuple('Line', [
         'project', 'title', 'agg_monthly_views', 'hourly_views'
@@ -59,36 +120,302 @@ class PagecountFileParser:
     hourly_views_pattern = re.compile(r'(?P<hour>[A-Z])(?P<views>\?|\d+)')
     missing_day = '*'
     missing_view = '?'
+    # sentinels used in (days x 24) arrays of the vectorized mode
+    absent_count = -1
+    missing_count = -2
+    # 'text' decodes every line of the file, 'bytes' looks for lines
+    # of the project in the raw bytes and decodes only them, 'sorted'
+    # in addition expects lines to be sorted (as they are in pagecount
+    # files) and reads only the block of the project
+    scan_modes = ('text', 'bytes', 'sorted')
 
-    def __init__(self, year, month, file_name, project):
+    def __init__(self, year, month, file_name, project, byte_range=None,
+                 scan='text', title_cache=title_cache,
+                 metrics=disabled_metrics):
         # TODO pass file name and infer year and month
         # from it
         self.year = year
         self.month = month
         self.file_name = file_name
         self.project = project
+        # (start, end) offsets of the part of the file to parse,
+        # start should be at the beginning of a line
+        self.byte_range = byte_range
+        if scan not in self.scan_modes:
+            raise ValueError('Unknown scan mode: {}'.format(scan))
+        self.scan = scan
+        self.title_cache = title_cache
+        self.metrics = metrics
+        self.compressed = is_compressed(file_name)
+        if self.compressed and (scan != 'text' or byte_range is not None):
+            raise ValueError(
+                'Compressed files can only be read from start to end'
+            )
+
+    @property
+    def days_in_month(self):
+        return monthrange(self.year, self.month)[1]
+
+    @property
+    def week_starts(self):
+        """
+        Indices of days of the month that begin an ISO week
+        (the first day of the month always does)
+        """
+        first_weekday = datetime(self.year, self.month, 1).weekday()
+        return np.array([0] + [
+            day for day in range(1, self.days_in_month)
+            if (first_weekday + day) % 7 == 0
+        ])
+
+    def parse(self, aggregate_by_day=True, vectorized=False, sink=None):
+        """
+        Yields (title, view_counts) for every line of the project,
+        view_counts being a dict of ISO timestamps to views.
+        With vectorized=True hourly views are decoded into numpy
+        arrays and timestamps are built only for the output.
+        Daily views of every title are also passed to sink.add (e.g.
+        trending.TrendingSink) if it's given, and sink.finish is
+        called at the end of the file.
+        """
+        yield from self.parse_lines(partial(
+            self.parse_view_counts, aggregate_by_day=aggregate_by_day,
+            vectorized=vectorized, sink=sink,
+        ))
+        if sink is not None:
+            sink.finish()
+
+    def parse_view_counts(self, line, aggregate_by_day=True,
+                          vectorized=False, sink=None):
+        """Returns (title, view_counts) of a line, see parse"""
+        metrics = self.metrics
+        if vectorized and sink is not None:
+            with metrics.timed('parse_line'):
+                title, hours = self.parse_line_array(line)
+            with metrics.timed('aggregate_days'):
+                days = self.aggregate_days_array(hours)
+                view_counts = (
+                    self.days_array_to_dict(days) if aggregate_by_day
+                    else self.hours_array_to_dict(hours)
+                )
+        elif vectorized:
+            title, view_counts = self.parse_line_vectorized(
+                line, aggregate_by_day
+            )
+        else:
+            with metrics.timed('parse_line'):
+                title, view_counts = self.parse_line(line)
+            if aggregate_by_day:
+                with metrics.timed('aggregate_days'):
+                    view_counts = self.aggregate_days(view_counts)
+            view_counts = apply_to_keys(
+                view_counts, lambda x: x.isoformat()
+            )
+            if sink is not None:
+                # daily totals imputed the same way whether
+                # or not view_counts are aggregated by day
+                _, hours = self.parse_line_array(line)
+                days = self.aggregate_days_array(hours)
+        if sink is not None:
+            with metrics.timed('sink'):
+                sink.add(title, days)
+        logger.debug('Parsed %s', title)
+        return title, view_counts
 
-    def parse(self, aggregate_by_day=True):
+    def parse_days(self):
+        """
+        Yields (title, days) for every line of the project, days
+        being an array of daily totals as returned by
+        aggregate_days_array.
+        """
+        yield from self.parse_lines(self.parse_line_days)
+
+    def parse_line_days(self, line):
+        with self.metrics.timed('parse_line'):
+            title, hours = self.parse_line_array(line)
+        with self.metrics.timed('aggregate_days'):
+            return title, self.aggregate_days_array(hours)
+
+    def parse_resolutions(self):
+        """
+        Yields (title, resolutions) for every line of the project,
+        resolutions being a dict as returned by aggregate_resolutions.
+        """
+        yield from self.parse_lines(partial(
+            self.parse_line_resolutions, week_starts=self.week_starts
+        ))
+
+    def parse_line_resolutions(self, line, week_starts=None):
+        with self.metrics.timed('parse_line'):
+            title, hours = self.parse_line_array(line)
+        with self.metrics.timed('aggregate_days'):
+            return title, self.aggregate_resolutions(hours, week_starts)
+
+    def parse_lines(self, parse_line):
+        """
+        Yields results of parse_line for every line of the project.
+        Lines it fails on are logged with their number and skipped.
+        """
         # count lines to make troubleshooting easier later
         line_counter = 0
-        with codecs.open(
-            self.file_name, 'r', encoding='utf-8', errors='ignore'
-        ) as pagecount_file:
-            lines = (line for line in pagecount_file
-                     if line.startswith(self.project))
-            for line in lines:
-                try:
+        metrics = self.metrics
+        for line in self.read_lines():
+            line_counter += 1
+            metrics.count('lines_matched')
+            try:
+                result = parse_line(line)
+            except Exception:
+                metrics.count('parse_errors')
+                logger.exception('Line number was {}'.format(line_counter))
+                continue
+            metrics.maybe_report()
+            yield result
+
+    def read_lines(self):
+        """
+        Yields decoded lines of the file (or of its byte_range)
+        that belong to the project.
+        """
+        if self.compressed:
+            project = self.project.encode('utf-8')
+            with open_compressed(self.file_name) as pagecount_file:
+                lines = self.metrics.counted(
+                    pagecount_file, 'lines_scanned', 'bytes_read'
+                )
+                for line in lines:
+                    if line.startswith(project):
+                        yield line.decode('utf-8', errors='ignore')
+            return
+        if self.byte_range is None and self.scan == 'text':
+            with codecs.open(
+                self.file_name, 'r', encoding='utf-8', errors='ignore'
+            ) as pagecount_file:
+                lines = self.metrics.counted(pagecount_file, 'lines_scanned')
+                yield from (line for line in lines
+                            if line.startswith(self.project))
+            self.metrics.count('bytes_read', path.getsize(self.file_name))
+            return
+        yield from (line for _, line in self.read_lines_with_offsets())
+
+    def read_lines_with_offsets(self):
+        """
+        Yields (offset, line) pairs for lines of the project in the
+        file (or its byte_range), offset being the position right
+        after the line. Doesn't work for compressed files.
+        """
+        if self.scan != 'text':
+            yield from self.scan_lines()
+            return
+        start, end = self.byte_range or (0, path.getsize(self.file_name))
+        project = self.project.encode('utf-8')
+        with open(self.file_name, 'rb') as pagecount_file:
+            pagecount_file.seek(start)
+            position = start
+            line_counter = 0
+            try:
+                while position < end:
+                    line = pagecount_file.readline()
+                    if not line:
+                        return
+                    position += len(line)
                     line_counter += 1
-                    title, view_counts = self.parse_line(line)
-                    print(title)
-                    if aggregate_by_day:
-                        view_counts = self.aggregate_days(view_counts)
-                    yield title, apply_to_keys(
-                        view_counts, lambda x: x.isoformat()
+                    if line.startswith(project):
+                        yield position, line.decode('utf-8', errors='ignore')
+            finally:
+                self.metrics.count('lines_scanned', line_counter)
+                self.metrics.count('bytes_read', position - start)
+
+    def scan_lines(self):
+        """
+        read_lines_with_offsets for 'bytes' and 'sorted' scan modes:
+        the file is memory-mapped and only lines of the project are
+        decoded.
+        """
+        project = self.project.encode('utf-8')
+        with open(self.file_name, 'rb') as pagecount_file:
+            try:
+                pagecount_map = mmap.mmap(
+                    pagecount_file.fileno(), 0, access=mmap.ACCESS_READ
+                )
+            except ValueError:
+                # empty file can't be mapped
+                return
+            with pagecount_map:
+                start, end = self.byte_range or (0, len(pagecount_map))
+                if self.scan == 'sorted':
+                    line_starts = self.iter_block_line_starts(
+                        pagecount_map, project, start, end
+                    )
+                else:
+                    line_starts = self.iter_project_line_starts(
+                        pagecount_map, project, start, end
                     )
-                except Exception:
-                    logger.exception('Line number was {}'.format(line_counter))
-                    continue
+                bytes_read = 0
+                try:
+                    for line_start in line_starts:
+                        line_end = pagecount_map.find(b'\n', line_start)
+                        if line_end == -1:
+                            line_end = len(pagecount_map)
+                        bytes_read += line_end + 1 - line_start
+                        yield line_end + 1, pagecount_map[
+                            line_start:line_end
+                        ].decode('utf-8', errors='ignore')
+                finally:
+                    # in 'bytes' mode the whole range is searched
+                    if self.scan == 'bytes':
+                        bytes_read = end - start
+                    self.metrics.count('bytes_read', bytes_read)
+
+    @staticmethod
+    def iter_project_line_starts(pagecount_map, project, start, end):
+        """
+        Yields offsets of lines in [start, end) that begin with project
+        using mmap.find, so other lines are never looked at in Python.
+        """
+        if pagecount_map[start:start + len(project)] == project:
+            yield start
+        needle = b'\n' + project
+        # a line that starts exactly at end belongs to the next range
+        search_end = min(end - 2 + len(needle), len(pagecount_map))
+        position = start
+        while True:
+            position = pagecount_map.find(needle, position, search_end)
+            if position == -1:
+                return
+            yield position + 1
+            position += 1
+
+    @staticmethod
+    def line_start_after(pagecount_map, offset, start):
+        """Returns offset of the first line that begins at or after offset"""
+        if offset <= start:
+            return start
+        newline = pagecount_map.find(b'\n', offset - 1)
+        return len(pagecount_map) if newline == -1 else newline + 1
+
+    def iter_block_line_starts(self, pagecount_map, project, start, end):
+        """
+        Yields offsets of lines in [start, end) that begin with project
+        for a file sorted by lines. The beginning of the block is found
+        by binary search and scanning stops at its end.
+        """
+        low, high = start, end
+        while low < high:
+            middle = (low + high) // 2
+            line_start = self.line_start_after(pagecount_map, middle, start)
+            line_prefix = pagecount_map[line_start:line_start + len(project)]
+            if line_start < end and line_prefix < project:
+                low = middle + 1
+            else:
+                high = middle
+        line_start = self.line_start_after(pagecount_map, low, start)
+        while line_start < end and pagecount_map[
+            line_start:line_start + len(project)
+        ] == project:
+            yield line_start
+            line_start = self.line_start_after(
+                pagecount_map, line_start + 1, start
+            )
 
     def parse_visits(self, views_string):
         monthly_views = {}
@@ -185,38 +512,198 @@ class PagecountFileParser:
                 aggregated, lambda x: mean if x is None else x
             )
 
+    def decode_title(self, title):
+        # most titles aren't quoted at all
+        if '%' not in title and '+' not in title:
+            return title.strip()
+        return self.title_cache(title)
+
     def parse_line(self, line):
         line = self.line_parts(*line.split())
-        # titles are sometimes at least double quoted
-        prev_title = ''
-        title = line.title
-        while title != prev_title:
-            title, prev_title = parse.unquote_plus(title).strip(), title
-        monthly_views = self.parse_visits(line.hourly_views)
+        title = self.decode_title(line.title)
+        with self.metrics.timed('parse_visits'):
+            monthly_views = self.parse_visits(line.hourly_views)
         return title, monthly_views
 
+    # Vectorized mode
 
-def format_for_influx_query(title, time, value):
-    return {
-        'measurement': 'page_views',
-        'tags': {'title': title},
-        'time': time,
-        'fields': {'value': value},
+    def decode_visits(self, views_string):
+        """
+        Decodes letter-coded views_string into a (days x 24) integer
+        array. Hours that aren't mentioned in the string are set to
+        absent_count, missing ones ('?') to missing_count. A missing
+        day ('*') is marked by missing_count in its first hour, the
+        same way parse_visits keys it by midnight.
+        """
+        hours = np.full(
+            (self.days_in_month, 24), self.absent_count, dtype=np.int64
+        )
+        views = (view for view in
+                 views_string.split(self.pageviews_separator)
+                 if view)
+        for day_views in views:
+            day = self.days_mapping[day_views[0]] - 1
+            hourly_views = day_views[1:]
+            if hourly_views.startswith(self.missing_day):
+                hours[day, 0] = self.missing_count
+                continue
+            for hour, count in self.hourly_views_pattern.findall(
+                hourly_views
+            ):
+                hours[day, self.hours_mapping[hour]] = (
+                    self.missing_count if count == self.missing_view
+                    else int(count)
+                )
+        return hours
+
+    def impute_hours_array(self, hours):
+        """
+        Array counterpart of process_hourly_views: in days with both
+        present and missing hours the missing ones are set to the
+        mean of the day (over 24 hours). Days without present hours
+        keep missing_count.
+        """
+        present = hours >= 0
+        missing = hours == self.missing_count
+        day_sums = np.where(present, hours, 0).sum(axis=1)
+        partial_days = missing.any(axis=1) & present.any(axis=1)
+        means = np.rint(day_sums / 24).astype(np.int64)
+        fill = missing & partial_days[:, np.newaxis]
+        return np.where(fill, means[:, np.newaxis], hours)
+
+    def aggregate_days_array(self, hours):
+        """
+        Array counterpart of aggregate_days. Takes imputed hours and
+        returns an array of daily totals where days missing entirely
+        are imputed with the mean of the month and days that aren't
+        in the file are set to absent_count.
+        """
+        listed_days = (hours != self.absent_count).any(axis=1)
+        present_days = (hours >= 0).any(axis=1)
+        missing_days = listed_days & ~present_days
+        days = np.where(hours >= 0, hours, 0).sum(axis=1)
+        if missing_days.any():
+            mean = round(int(days[present_days].sum()) / self.days_in_month)
+            days[missing_days] = mean
+        days[~listed_days] = self.absent_count
+        return days
+
+    def hours_array_to_dict(self, hours):
+        return {
+            datetime(self.year, self.month, day + 1, hour).isoformat():
+            None if count == self.missing_count else int(count)
+            for (day, hour), count in np.ndenumerate(hours)
+            if count != self.absent_count
+        }
+
+    def days_array_to_dict(self, days):
+        return {
+            datetime(self.year, self.month, day + 1).isoformat(): int(count)
+            for day, count in enumerate(days)
+            if count != self.absent_count
+        }
+
+    def aggregate_resolutions(self, hours, week_starts=None):
+        """
+        Takes imputed hours and returns a dict of 'hour', 'day', 'week'
+        and 'month' to dicts of ISO timestamps to views. Weeks are ISO
+        weeks, but only the days of this month are counted, so a week
+        that spans two months is split in two points: one at the
+        week's first day in each month.
+        """
+        if week_starts is None:
+            week_starts = self.week_starts
+        days = self.aggregate_days_array(hours)
+        listed_days = days != self.absent_count
+        day_totals = np.where(listed_days, days, 0)
+        week_totals = np.add.reduceat(day_totals, week_starts)
+        listed_weeks = np.logical_or.reduceat(listed_days, week_starts)
+        month_start = datetime(self.year, self.month, 1).isoformat()
+        return {
+            'hour': self.hours_array_to_dict(hours),
+            'day': self.days_array_to_dict(days),
+            'week': {
+                datetime(self.year, self.month, day + 1).isoformat():
+                int(count)
+                for day, count, listed in zip(
+                    week_starts, week_totals, listed_weeks
+                )
+                if listed
+            },
+            'month': (
+                {month_start: int(day_totals.sum())}
+                if listed_days.any() else {}
+            ),
+        }
+
+    def parse_line_array(self, line):
+        """Returns title and array of imputed hourly views for a line"""
+        line = self.line_parts(*line.split())
+        title = self.decode_title(line.title)
+        with self.metrics.timed('parse_visits'):
+            hours = self.impute_hours_array(
+                self.decode_visits(line.hourly_views)
+            )
+        return title, hours
+
+    def parse_line_vectorized(self, line, aggregate_by_day=True):
+        """
+        Same as parse_line followed by aggregate_days (if needed)
+        but done with array operations.
+        """
+        with self.metrics.timed('parse_line'):
+            title, hours = self.parse_line_array(line)
+        if aggregate_by_day:
+            with self.metrics.timed('aggregate_days'):
+                return title, self.days_array_to_dict(
+                    self.aggregate_days_array(hours)
+                )
+        return title, self.hours_array_to_dict(hours)
+
+
+def load_pageviews_to_influx(page_counts_data, batch_size=5000,
+                             metrics=disabled_metrics):
+    with InfluxBatchWriter(batch_size=batch_size, metrics=metrics) as writer:
+        for title, view_counts in page_counts_data:
+            writer.write(title, view_counts)
+
+
+def create_retention_policies(client, tiers=RESOLUTION_TIERS):
+    existing = {
+        policy['name'] for policy in client.get_list_retention_policy()
     }
+    for policy, duration in tiers.values():
+        if policy is not None and policy not in existing:
+            client.create_retention_policy(policy, duration, replication=1)
+
 
+def load_resolutions_to_influx(resolutions_data, tiers=RESOLUTION_TIERS,
+                               batch_size=5000, metrics=disabled_metrics):
+    """
+    Writes output of PagecountFileParser.parse_resolutions, every
+    resolution to its own retention policy.
+    """
+    writers = {
+        resolution: InfluxBatchWriter(
+            batch_size=batch_size, retention_policy=policy, metrics=metrics
+        )
+        for resolution, (policy, _) in tiers.items()
+    }
+    create_retention_policies(next(iter(writers.values())).client, tiers)
+    try:
+        for title, resolutions in resolutions_data:
+            for resolution, writer in writers.items():
+                writer.write(title, resolutions[resolution])
+    finally:
+        for writer in writers.values():
+            writer.close()
 
-def load_pageviews_to_influx(page_counts_data):
-    client = InfluxDBClient('localhost', 8086, database='wiki_pageviews')
-    for title, view_counts in page_counts_data:
-        entries = [
-            format_for_influx_query(title, time, value) for
-            time, value in view_counts.items()
-        ]
-        client.write_points(entries)
 
 if __name__ == '__main__':
+    metrics = PipelineMetrics()
     parser = PagecountFileParser(
         file_name='../data/pageviews/test_lines',
-        year=2011, month=12, project='uk.z'
+        year=2011, month=12, project='uk.z', metrics=metrics,
     )
-    load_pageviews_to_influx(parser.parse())
+    load_pageviews_to_influx(parser.parse(), metrics=metrics)
+    metrics.dump('metrics.json')
@@ -0,0 +1,224 @@
+import argparse
+from collections import Counter
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
+import logging
+import os
+
+import numpy as np
+
+from pageviews_parse.pageview_data_downloader import is_compressed
+from pageviews_parse.pageview_data_downloader import PagecountFileParser
+from pageviews_parse.pageview_data_downloader import load_pageviews_to_influx
+
+logger = logging.getLogger('wiki')
+
+
+# parse many monthly files (or parts of one big file) in worker
+# processes and merge their results into per-title daily series
+
+# the name has to match the type name so that tasks can be pickled
+ParseTask = namedtuple('ParseTask', [
+    'year', 'month', 'file_name', 'project', 'byte_range', 'scan'
+], defaults=(None, 'text'))
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "file_template",
+        help="Path to monthly files with {year} and {month} placeholders"
+    )
+    parser.add_argument("start", help="First month as YYYY-MM")
+    parser.add_argument("end", help="Last month as YYYY-MM")
+    parser.add_argument("-p", "--project", default='uk.z')
+    parser.add_argument(
+        "-w", "--workers", type=int, help="Number of worker processes"
+    )
+    parser.add_argument(
+        "-c", "--chunks", type=int, default=1,
+        help="Number of byte ranges each file is split into"
+    )
+    parser.add_argument(
+        "-s", "--scan", choices=PagecountFileParser.scan_modes,
+        default='text', help="How lines of the project are found"
+    )
+    return parser
+
+
+def generate_months(start, end):
+    """Yields (year, month) tuples from start to end inclusive"""
+    year, month = start
+    while (year, month) <= end:
+        yield year, month
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def split_by_lines(file_name, parts):
+    """
+    Splits file into at most 'parts' (start, end) byte ranges
+    of roughly equal size that begin at the beginning of a line.
+    """
+    size = os.path.getsize(file_name)
+    starts = [0]
+    with open(file_name, 'rb') as file_:
+        for i in range(1, parts):
+            file_.seek(max(size * i // parts, starts[-1]))
+            # skip to the beginning of the next line
+            file_.readline()
+            if file_.tell() >= size:
+                break
+            if file_.tell() > starts[-1]:
+                starts.append(file_.tell())
+    return list(zip(starts, starts[1:] + [size]))
+
+
+def generate_tasks(file_template, start, end, project, chunks_per_file=1,
+                   scan='text'):
+    """
+    Yields tasks for monthly files from start to end, files that
+    don't exist are logged and skipped. Compressed files can only be
+    parsed whole, in 'text' scan mode.
+    """
+    if is_compressed(file_template) and (
+        chunks_per_file != 1 or scan != 'text'
+    ):
+        raise ValueError(
+            'Compressed files can only be read from start to end, '
+            'use one chunk per file and text scan mode'
+        )
+    for year, month in generate_months(start, end):
+        file_name = file_template.format(year=year, month=month)
+        if not os.path.exists(file_name):
+            logger.warning('%s not found, skipping it', file_name)
+            continue
+        if chunks_per_file == 1:
+            yield ParseTask(year, month, file_name, project, None, scan)
+            continue
+        for byte_range in split_by_lines(file_name, chunks_per_file):
+            yield ParseTask(year, month, file_name, project, byte_range, scan)
+
+
+def parse_chunk(task):
+    """
+    Runs in a worker process. Returns the task, a list of titles and
+    a (titles x days) array of their daily views.
+    """
+    parser = PagecountFileParser(*task)
+    titles = []
+    days = []
+    for title, day_counts in parser.parse_days():
+        titles.append(title)
+        days.append(day_counts)
+    if not days:
+        return task, titles, np.empty((0, parser.days_in_month), np.int64)
+    return task, titles, np.vstack(days)
+
+
+def merge_days(merged, titles, days):
+    """
+    Adds rows of days to the arrays in 'merged' dict by title.
+    Views of titles that occur several times (e.g. differently
+    quoted) are summed, absent days stay absent.
+    """
+    absent = PagecountFileParser.absent_count
+    for title, row in zip(titles, days):
+        if title not in merged:
+            merged[title] = row
+            continue
+        prev = merged[title]
+        merged[title] = np.where(
+            prev == absent, row,
+            np.where(row == absent, prev, prev + row)
+        )
+    return merged
+
+
+def file_key(task):
+    return task.year, task.month, task.file_name
+
+
+def parse_in_parallel(tasks, workers=None, max_pending=None,
+                      failed_files=None):
+    """
+    Parses tasks in a pool of worker processes. Yields (title, views)
+    pairs, where views is a dict of ISO dates to daily views, for each
+    file as soon as all its chunks are parsed.
+
+    At most max_pending tasks (twice the number of workers by default)
+    are submitted at a time, so for tasks that are ordered by file only
+    a few months are kept in memory.
+
+    A file with a chunk that fails is logged and skipped, its name
+    is appended to failed_files if it's given.
+    """
+    tasks = list(tasks)
+    workers = workers or os.cpu_count()
+    max_pending = max_pending or workers * 2
+    failed_keys = set()
+    chunks_left = Counter(file_key(task) for task in tasks)
+    merged_files = {}
+    tasks_iter = iter(tasks)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        futures = {}
+        while True:
+            for task in tasks_iter:
+                future = executor.submit(parse_chunk, task)
+                futures[future] = task
+                pending.add(future)
+                if len(pending) >= max_pending:
+                    break
+            if not pending:
+                return
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = futures.pop(future)
+                key = file_key(task)
+                chunks_left[key] -= 1
+                try:
+                    _, titles, days = future.result()
+                except Exception:
+                    logger.exception(
+                        'Failed to parse %s (%s)', task.file_name,
+                        task.byte_range or 'whole file',
+                    )
+                    if key not in failed_keys:
+                        failed_keys.add(key)
+                        if failed_files is not None:
+                            failed_files.append(task.file_name)
+                    merged_files.pop(key, None)
+                    continue
+                if key in failed_keys:
+                    continue
+                merged = merge_days(
+                    merged_files.setdefault(key, {}), titles, days
+                )
+                if chunks_left[key]:
+                    continue
+                del merged_files[key]
+                parser = PagecountFileParser(*task)
+                for title, day_counts in merged.items():
+                    yield title, parser.days_array_to_dict(day_counts)
+
+
+if __name__ == '__main__':
+    args = get_arg_parser().parse_args()
+    tasks = generate_tasks(
+        args.file_template,
+        tuple(map(int, args.start.split('-'))),
+        tuple(map(int, args.end.split('-'))),
+        args.project,
+        chunks_per_file=args.chunks,
+        scan=args.scan,
+    )
+    failed_files = []
+    load_pageviews_to_influx(parse_in_parallel(
+        tasks, workers=args.workers, failed_files=failed_files
+    ))
+    if failed_files:
+        logger.error(
+            '%d files failed: %s', len(failed_files), ', '.join(failed_files)
+        )
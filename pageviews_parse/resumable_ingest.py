@@ -0,0 +1,169 @@
+import argparse
+import json
+import logging
+import os
+from os import path
+import time
+
+from pageviews_parse.influx_writer import InfluxBatchWriter
+from pageviews_parse.metrics import PipelineMetrics
+from pageviews_parse.pageview_data_downloader import PagecountFileParser
+
+logger = logging.getLogger('wiki')
+
+
+# Loading of a pagecount file to InfluxDB that can be continued after
+# a crash. Every checkpoint_interval seconds the writer is drained and
+# the offset after the last written line is saved to a checkpoint file,
+# on restart the file is read from that offset. Points are keyed by
+# title and time, so lines that are written again after a restart
+# overwrite the same points instead of being counted twice. Points
+# InfluxDB refuses to parse can never be written, they are quarantined
+# in <checkpoint file>.rejected and the checkpoint moves past them.
+
+REJECTED_SUFFIX = '.rejected'
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("file_name")
+    parser.add_argument("year", type=int)
+    parser.add_argument("month", type=int)
+    parser.add_argument("checkpoint_file")
+    parser.add_argument("-p", "--project", default='uk.z')
+    parser.add_argument(
+        "-i", "--interval", type=float, default=60.0,
+        help="Seconds between checkpoints"
+    )
+    parser.add_argument(
+        "-m", "--metrics", help="Dump pipeline metrics as JSON to this file"
+    )
+    return parser
+
+
+def read_checkpoint(checkpoint_file, parser):
+    """
+    Returns (offset, line_counter, finished) saved for the parser's
+    file and project or the beginning of the file if there's no
+    checkpoint yet.
+    """
+    if not path.exists(checkpoint_file):
+        return 0, 0, False
+    with open(checkpoint_file) as file_:
+        checkpoint = json.load(file_)
+    if (checkpoint['file_name'], checkpoint['project']) != (
+        parser.file_name, parser.project
+    ):
+        raise ValueError(
+            'Checkpoint {} is for {} ({})'.format(
+                checkpoint_file, checkpoint['file_name'],
+                checkpoint['project'],
+            )
+        )
+    return (
+        checkpoint['offset'], checkpoint['line_counter'],
+        checkpoint['finished'],
+    )
+
+
+def write_checkpoint(checkpoint_file, parser, offset, line_counter,
+                     finished=False):
+    # write to another file and rename it so that a crash
+    # never leaves a half written checkpoint
+    tmp_file = checkpoint_file + '.tmp'
+    with open(tmp_file, 'w') as file_:
+        json.dump({
+            'file_name': parser.file_name,
+            'project': parser.project,
+            'offset': offset,
+            'line_counter': line_counter,
+            'finished': finished,
+        }, file_)
+        file_.flush()
+        os.fsync(file_.fileno())
+    os.replace(tmp_file, checkpoint_file)
+
+
+def save_written(writer, checkpoint_file, parser, offset, line_counter,
+                 finished=False):
+    """
+    Waits for the writer and saves checkpoint if nothing was lost
+    (except for rejected points, which are in the writer's
+    rejected_file)
+    """
+    failed_batches = writer.failed_batches
+    points_rejected = writer.points_rejected
+    writer.wait()
+    if writer.failed_batches != failed_batches:
+        raise IOError(
+            'Some points before line {} were not written, '
+            'restart the job to write them again'.format(line_counter)
+        )
+    if writer.points_rejected != points_rejected:
+        logger.warning(
+            '%d points before line %d were rejected, see %s',
+            writer.points_rejected - points_rejected, line_counter,
+            writer.rejected_file,
+        )
+    write_checkpoint(
+        checkpoint_file, parser, offset, line_counter, finished
+    )
+    logger.info('Checkpoint at line %d (byte %d)', line_counter, offset)
+
+
+def ingest_resumable(parser, checkpoint_file, writer=None,
+                     checkpoint_interval=60.0, aggregate_by_day=True):
+    """
+    Loads pageviews parsed by 'parser' to InfluxDB starting from the
+    last checkpoint. Compressed files can't be resumed this way since
+    they can't be read from an offset.
+    """
+    if parser.compressed:
+        raise ValueError('Compressed files can only be read from start to end')
+    offset, line_counter, finished = read_checkpoint(checkpoint_file, parser)
+    if finished:
+        logger.info('%s is already loaded', parser.file_name)
+        return
+    parser.byte_range = (offset, path.getsize(parser.file_name))
+    writer = writer or InfluxBatchWriter(
+        metrics=parser.metrics,
+        rejected_file=checkpoint_file + REJECTED_SUFFIX,
+    )
+    last_checkpoint = time.monotonic()
+    with writer:
+        for offset, line in parser.read_lines_with_offsets():
+            line_counter += 1
+            parser.metrics.count('lines_matched')
+            try:
+                title, view_counts = parser.parse_line_vectorized(
+                    line, aggregate_by_day
+                )
+            except Exception:
+                parser.metrics.count('parse_errors')
+                logger.exception('Line number was {}'.format(line_counter))
+                continue
+            writer.write(title, view_counts)
+            parser.metrics.maybe_report()
+            if time.monotonic() - last_checkpoint >= checkpoint_interval:
+                save_written(
+                    writer, checkpoint_file, parser, offset, line_counter
+                )
+                last_checkpoint = time.monotonic()
+        save_written(
+            writer, checkpoint_file, parser, parser.byte_range[1],
+            line_counter, finished=True,
+        )
+
+
+if __name__ == '__main__':
+    args = get_arg_parser().parse_args()
+    metrics = PipelineMetrics(enabled=args.metrics is not None)
+    parser = PagecountFileParser(
+        args.year, args.month, args.file_name, args.project,
+        metrics=metrics,
+    )
+    ingest_resumable(
+        parser, args.checkpoint_file, checkpoint_interval=args.interval
+    )
+    if args.metrics:
+        metrics.dump(args.metrics)
@@ -0,0 +1,241 @@
+import argparse
+from calendar import monthrange
+from datetime import date
+import hashlib
+import heapq
+import json
+import logging
+import math
+
+import numpy as np
+
+from pageviews_parse.pageview_data_downloader import PagecountFileParser
+
+logger = logging.getLogger('wiki')
+
+
+# Most viewed and spiking titles found in the same pass that parses a
+# pagecount file, in memory that doesn't grow with the number of titles.
+# Views are counted in a count-min sketch with a slot for every day of
+# the month and one for the whole month, and a heap of the n titles
+# with the largest estimates is kept per slot. Estimates can only be
+# too high, by views of titles that collide with the title in every row
+# of the sketch. Spikes are days whose views are more than 'threshold'
+# exponentially weighted standard deviations above the exponentially
+# weighted mean of the previous days of the title.
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("file_name")
+    parser.add_argument("year", type=int)
+    parser.add_argument("month", type=int)
+    parser.add_argument("-p", "--project", default='uk.z')
+    parser.add_argument("-n", type=int, default=20)
+    parser.add_argument("--threshold", type=float, default=3.0)
+    parser.add_argument("--min-views", type=int, default=100)
+    parser.add_argument("-o", "--output", help="Write the report as json")
+    return parser
+
+
+class CountMinSketch:
+    """
+    Counts of keys in several slots at once (e.g. days), every key is
+    hashed to one counter per row and its estimate is their minimum.
+    """
+    def __init__(self, slots, width=2**14, depth=4):
+        self.width = width
+        self.rows = np.arange(depth)
+        # rows of every slot are laid out one after another
+        self.table = np.zeros((slots, depth * width), dtype=np.int64)
+
+    def cells(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+        first = int.from_bytes(digest[:4], 'little')
+        second = int.from_bytes(digest[4:], 'little') | 1
+        return self.rows * self.width + (
+            first + self.rows * second
+        ) % self.width
+
+    def add(self, key, counts):
+        """Adds an array of counts (one per slot), returns estimates"""
+        cells = self.cells(key)
+        counters = self.table[:, cells] + counts[:, np.newaxis]
+        self.table[:, cells] = counters
+        return counters.min(axis=1)
+
+    def estimate(self, key):
+        return self.table[:, self.cells(key)].min(axis=1)
+
+
+class TopN:
+    """n keys with the largest values pushed so far"""
+    def __init__(self, n):
+        self.n = n
+        self.heap = []
+        self.values = {}
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, key, value):
+        if key in self.values:
+            if value > self.values[key]:
+                self.values[key] = value
+                self.heap = [
+                    (heap_value, heap_key)
+                    for heap_key, heap_value in self.values.items()
+                ]
+                heapq.heapify(self.heap)
+            return
+        if len(self.heap) < self.n:
+            heapq.heappush(self.heap, (value, key))
+        elif value > self.heap[0][0]:
+            _, dropped = heapq.heapreplace(self.heap, (value, key))
+            del self.values[dropped]
+        else:
+            return
+        self.values[key] = value
+
+    def items(self):
+        """Returns [(key, value)] from the largest value down"""
+        return sorted(self.values.items(), key=lambda item: item[1],
+                      reverse=True)
+
+
+def ewma_spikes(days, alpha, threshold, min_views, warmup):
+    """
+    Yields (day index, views, z-score) of days that are spikes. Days
+    before 'warmup' are only used to estimate the mean and variance.
+    """
+    mean = float(days[0])
+    variance = 0.0
+    for day, views in enumerate(days.tolist()):
+        if day >= warmup and views >= min_views:
+            z_score = (views - mean) / max(math.sqrt(variance), 1.0)
+            if z_score >= threshold:
+                yield day, views, z_score
+        difference = views - mean
+        increment = alpha * difference
+        mean += increment
+        variance = (1 - alpha) * (variance + difference * increment)
+
+
+class TrendingSink:
+    """
+    Collects top n titles per day and per month and top n spikes
+    per day from titles' daily views. Pass it to
+    PagecountFileParser.parse:
+
+        sink = TrendingSink(year, month)
+        for title, view_counts in parser.parse(sink=sink):
+            ...
+        report = sink.report()
+
+    Every report_interval titles (and when the file ends) the current
+    report is passed to on_report, which logs it by default.
+    """
+    def __init__(self, year, month, n=20, width=2**14, depth=4, alpha=0.3,
+                 threshold=3.0, min_views=100, warmup=7,
+                 report_interval=None, on_report=None):
+        self.year = year
+        self.month = month
+        self.days_in_month = monthrange(year, month)[1]
+        self.alpha = alpha
+        self.threshold = threshold
+        self.min_views = min_views
+        self.warmup = warmup
+        self.report_interval = report_interval
+        self.on_report = on_report or self.log_report
+        # the last slot counts the whole month
+        self.sketch = CountMinSketch(self.days_in_month + 1, width, depth)
+        self.top = [TopN(n) for _ in range(self.days_in_month + 1)]
+        # smallest estimates in full heaps of self.top, most titles
+        # are below them and don't have to be pushed at all
+        self.top_floors = np.zeros(self.days_in_month + 1, dtype=np.int64)
+        self.spikes = [TopN(n) for _ in range(self.days_in_month)]
+        self.titles_added = 0
+
+    def add(self, title, days):
+        """
+        Takes daily views of a title as returned by
+        PagecountFileParser.aggregate_days_array
+        """
+        days = np.maximum(days, 0)
+        counts = np.concatenate((days, [days.sum()]))
+        estimates = self.sketch.add(title, counts)
+        for slot in np.flatnonzero(estimates > self.top_floors).tolist():
+            top = self.top[slot]
+            top.push(title, int(estimates[slot]))
+            if len(top) == top.n:
+                self.top_floors[slot] = top.heap[0][0]
+        if days.max() >= self.min_views:
+            for day, views, z_score in ewma_spikes(
+                days, self.alpha, self.threshold, self.min_views,
+                self.warmup,
+            ):
+                self.spikes[day].push(title, (z_score, views))
+        self.titles_added += 1
+        if (
+            self.report_interval and
+            self.titles_added % self.report_interval == 0
+        ):
+            self.on_report(self.report())
+
+    def finish(self):
+        self.on_report(self.report())
+
+    def report(self):
+        """
+        Returns dict with
+            'month'    - [(title, views)] of the month
+            'days'     - {ISO date: [(title, views)]}
+            'trending' - {ISO date: [(title, views, z-score)]}
+        """
+        dates = [
+            date(self.year, self.month, day + 1).isoformat()
+            for day in range(self.days_in_month)
+        ]
+        return {
+            'month': self.top[-1].items(),
+            'days': {
+                day: top.items()
+                for day, top in zip(dates, self.top) if len(top)
+            },
+            'trending': {
+                day: [
+                    (title, views, round(z_score, 2))
+                    for title, (z_score, views) in spikes.items()
+                ]
+                for day, spikes in zip(dates, self.spikes) if len(spikes)
+            },
+        }
+
+    def log_report(self, report):
+        logger.info(
+            'Trending after %d titles, top of month: %s',
+            self.titles_added, report['month'][:5],
+        )
+
+
+if __name__ == '__main__':
+    args = get_arg_parser().parse_args()
+    parser = PagecountFileParser(
+        args.year, args.month, args.file_name, args.project
+    )
+    sink = TrendingSink(
+        args.year, args.month, args.n, threshold=args.threshold,
+        min_views=args.min_views,
+    )
+    for _ in parser.parse(vectorized=True, sink=sink):
+        pass
+    report = sink.report()
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            json.dump(report, output_file, ensure_ascii=False, indent=2)
+    else:
+        for title, views in report['month']:
+            print(views, title)
+        for day, spikes in report['trending'].items():
+            for title, views, z_score in spikes:
+                print(day, views, z_score, title)
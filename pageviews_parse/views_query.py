@@ -0,0 +1,256 @@
+import argparse
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+
+from influxdb import InfluxDBClient
+import numpy as np
+import pandas as pd
+
+from categories.topic_index import TopicIndex
+from db.db_conf import get_engine
+from db.title_resolver import get_titles
+from db.title_resolver import LRUCache
+from db.title_resolver import pageview_title
+from pageviews_parse.influx_writer import INFLUX_DATABASE
+from pageviews_parse.influx_writer import INFLUX_HOST
+from pageviews_parse.influx_writer import INFLUX_PORT
+from pageviews_parse.influx_writer import MEASUREMENT
+from pageviews_parse.influx_writer import to_epoch_seconds
+from pageviews_parse.pageview_data_downloader import RESOLUTION_TIERS
+
+
+# Read side of the page_views measurement. Series of many titles are
+# fetched with one query per chunk of titles, and views are summed by
+# InfluxDB for top lists. Raw results are turned into numpy arrays
+# without going through a dict per point and the arrays of recent
+# queries are cached for cache_ttl seconds.
+#
+# Weeks are stored as partial points (one per month a week touches),
+# get_series sums them back into ISO weeks.
+
+EPOCH_MONDAY = np.datetime64('1969-12-29')
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default=INFLUX_HOST)
+    parser.add_argument("--port", type=int, default=INFLUX_PORT)
+    parser.add_argument("--database", default=INFLUX_DATABASE)
+    parser.add_argument(
+        "-r", "--resolution", default='day', choices=list(RESOLUTION_TIERS)
+    )
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    series_parser = subparsers.add_parser(
+        'series', help="Print views of titles"
+    )
+    series_parser.add_argument("start", type=date.fromisoformat)
+    series_parser.add_argument("end", type=date.fromisoformat)
+    series_parser.add_argument("titles", nargs='+')
+    top_parser = subparsers.add_parser('top', help="Print most viewed titles")
+    top_parser.add_argument("start", type=date.fromisoformat)
+    top_parser.add_argument("end", type=date.fromisoformat)
+    top_parser.add_argument("n", type=int)
+    top_parser.add_argument("--topic")
+    top_parser.add_argument(
+        "--topic-index", help="Directory of categories.topic_index"
+    )
+    return parser
+
+
+def quote_string(value):
+    """Quotes string literal for InfluxQL"""
+    return "'{}'".format(value.replace('\\', '\\\\').replace("'", "\\'"))
+
+
+def quote_identifier(value):
+    return '"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))
+
+
+def is_date(time_):
+    return isinstance(time_, date) and not isinstance(time_, datetime)
+
+
+def time_literal(time_):
+    """
+    Accepts date, datetime or ISO string (naive ones are UTC)
+    and returns it as InfluxQL epoch literal
+    """
+    if is_date(time_):
+        time_ = datetime(time_.year, time_.month, time_.day)
+    return '{}s'.format(to_epoch_seconds(time_))
+
+
+def week_starts(times):
+    """Returns mondays of ISO weeks of datetime64 times"""
+    days = times.astype('datetime64[D]')
+    return days - (days - EPOCH_MONDAY) % np.timedelta64(7, 'D')
+
+
+class PageviewsQuery:
+    """
+    Usage:
+        query = PageviewsQuery()
+        df = query.get_series(['Київ', 'Львів'], start, end, 'week')
+        top = query.top_n(start, end, 10)
+
+    start and end are inclusive, an end date includes all of its
+    hours. Days are read from the default retention policy and other
+    resolutions from their tiers (RESOLUTION_TIERS). Results of
+    queries are cached for cache_ttl seconds. top_n with a topic needs
+    topic_index (categories.topic_index.TopicIndex) and an engine of
+    the database with pages to map page ids to titles.
+    """
+    def __init__(self, host=INFLUX_HOST, port=INFLUX_PORT,
+                 database=INFLUX_DATABASE, measurement=MEASUREMENT,
+                 tiers=RESOLUTION_TIERS, chunk_size=200, cache_size=256,
+                 cache_ttl=300, client=None, topic_index=None, engine=None):
+        self.client = client or InfluxDBClient(host, port, database=database)
+        self.measurement = measurement
+        self.tiers = tiers
+        self.chunk_size = chunk_size
+        self.cache = LRUCache(cache_size, cache_ttl)
+        self.topic_index = topic_index
+        self.engine = engine
+
+    def _source(self, resolution):
+        if resolution not in self.tiers:
+            raise ValueError('Unknown resolution: {}'.format(resolution))
+        policy = self.tiers[resolution][0]
+        measurement = quote_identifier(self.measurement)
+        if policy is None:
+            return measurement
+        return '{}.{}'.format(quote_identifier(policy), measurement)
+
+    def _where(self, start, end, titles=None):
+        if is_date(end):
+            # the whole last day, hours included
+            end_condition = 'time < {}'.format(
+                time_literal(end + timedelta(days=1))
+            )
+        else:
+            end_condition = 'time <= {}'.format(time_literal(end))
+        conditions = ['time >= {}'.format(time_literal(start)), end_condition]
+        if titles is not None:
+            conditions.append('({})'.format(' OR '.join(
+                '"title" = {}'.format(quote_string(title)) for title in titles
+            )))
+        return ' AND '.join(conditions)
+
+    def _execute(self, query):
+        """
+        Returns {title: (epoch seconds, values)} arrays of series
+        returned by query (grouped by title), results are cached.
+        """
+        result = self.cache.get(query)
+        if result is not None:
+            return result
+        raw = self.client.query(query, epoch='s').raw
+        result = {}
+        for series in raw.get('series', []):
+            values = np.array(series['values'], dtype=np.int64)
+            values.setflags(write=False)
+            result[series['tags']['title']] = (values[:, 0], values[:, 1])
+        self.cache.put(query, result)
+        return result
+
+    def _chunks(self, titles):
+        # sorted so that the same titles make the same queries
+        titles = sorted(set(titles))
+        for start in range(0, len(titles), self.chunk_size):
+            yield titles[start:start + self.chunk_size]
+
+    def get_series(self, titles, start, end, resolution='day'):
+        """
+        Returns DataFrame of views with a column per title indexed by
+        time. Times for which a title has no points have 0 views.
+        """
+        titles = list(titles)
+        series = {}
+        for chunk in self._chunks(titles):
+            series.update(self._execute(
+                'SELECT "value" FROM {} WHERE {} GROUP BY "title"'.format(
+                    self._source(resolution), self._where(start, end, chunk)
+                )
+            ))
+        times = np.unique(np.concatenate(
+            [times for times, _ in series.values()] + [np.empty(0, np.int64)]
+        ))
+        views = np.zeros((len(times), len(titles)), dtype=np.int64)
+        for column, title in enumerate(titles):
+            if title in series:
+                title_times, title_views = series[title]
+                views[np.searchsorted(times, title_times), column] = (
+                    title_views
+                )
+        times = times.astype('datetime64[s]')
+        if resolution == 'week' and len(times):
+            weeks = week_starts(times)
+            times, starts = np.unique(weeks, return_index=True)
+            views = np.add.reduceat(views, starts, axis=0)
+        return pd.DataFrame(
+            views, index=pd.DatetimeIndex(times, name='time'), columns=titles
+        )
+
+    def _total_views(self, start, end, resolution, titles=None):
+        """Returns (titles, totals) arrays"""
+        queries = [
+            'SELECT sum("value") FROM {} WHERE {} GROUP BY "title"'.format(
+                self._source(resolution), self._where(start, end, chunk)
+            )
+            for chunk in (
+                [None] if titles is None else self._chunks(titles)
+            )
+        ]
+        found_titles = []
+        totals = []
+        for query in queries:
+            for title, (_, values) in self._execute(query).items():
+                found_titles.append(title)
+                totals.append(values[0])
+        return np.array(found_titles, dtype=object), np.array(
+            totals, dtype=np.int64
+        )
+
+    def topic_titles(self, topic):
+        """Returns titles (as in pagecount files) of articles in topic"""
+        if self.topic_index is None:
+            raise ValueError('Topics need a topic index')
+        page_ids = self.topic_index.pages_in_topic(topic)
+        titles = get_titles(
+            self.engine or get_engine(), page_ids.tolist()
+        )
+        return [pageview_title(title) for title in titles.values()]
+
+    def top_n(self, start, end, n, topic=None, resolution='day'):
+        """
+        Returns [(title, views)] of the n most viewed titles (of the
+        topic if it's given) between start and end
+        """
+        titles = self.topic_titles(topic) if topic is not None else None
+        titles, totals = self._total_views(start, end, resolution, titles)
+        n = min(n, len(totals))
+        top = np.argpartition(-totals, n - 1)[:n] if n else []
+        top = sorted(top, key=lambda index: -totals[index])
+        return [(titles[index], int(totals[index])) for index in top]
+
+
+if __name__ == '__main__':
+    args = get_arg_parser().parse_args()
+    topic_index = None
+    if args.command == 'top' and args.topic_index:
+        topic_index = TopicIndex(args.topic_index)
+    query = PageviewsQuery(
+        args.host, args.port, args.database, topic_index=topic_index
+    )
+    if args.command == 'series':
+        df = query.get_series(
+            args.titles, args.start, args.end, args.resolution
+        )
+        print(df.to_string())
+    else:
+        top = query.top_n(
+            args.start, args.end, args.n, args.topic, args.resolution
+        )
+        for title, views in top:
+            print(views, title)
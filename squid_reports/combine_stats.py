@@ -1,4 +1,3 @@
-from datetime import date
 from os import path
 
 import pandas as pd
@@ -7,12 +6,22 @@ import ggplot as gp
 data_path = path.join(
     path.dirname(path.realpath(__file__)), 'data'
 )
+STATS_FILES = ('older_stats.csv', 'newer_stats.csv')
+# rebuilt when it's older than any of STATS_FILES
+COMBINED_FILE = 'combined_stats.parquet'
 
 
-def date_from_quarter(quarter):
-    year, q = quarter.split()
-    month = int(q[1]) * 3
-    return pd.Timestamp(date(year=int(year), month=month, day=1))
+def dates_from_quarters(quarters):
+    """
+    Converts a Series of quarters like ' 2013 Q4 ' to dates of the
+    first day of their last months
+    """
+    parts = quarters.str.extract(r'(?P<year>\d{4})\s*Q(?P<quarter>\d)')
+    return pd.to_datetime(pd.DataFrame({
+        'year': parts['year'].astype(int),
+        'month': parts['quarter'].astype(int) * 3,
+        'day': 1,
+    }))
 
 
 def process_older_stats():
@@ -22,15 +31,15 @@ def process_older_stats():
     cols_to_return = ['Date', 'Ukrainian', 'Russian', 'English', 'Other']
 
     # convert quarters into dates
-    stats['Date'] = stats['Quarter'].apply(date_from_quarter)
+    stats['Date'] = dates_from_quarters(stats['Quarter'])
     stats = stats.drop(['Quarter', 'Share'], axis=1)
 
     # strip % from values
-    percent_colnames = list(
-        filter(lambda x: x != 'Date', stats.columns)
-    )
-    stats[percent_colnames] = stats[percent_colnames].apply(
-        lambda x: x.str.strip('%').astype(float)
+    percent_colnames = [col for col in stats.columns if col != 'Date']
+    stats[percent_colnames] = (
+        stats[percent_colnames]
+        .replace('%', '', regex=True)
+        .astype(float)
     )
 
     # sum all columns that are not of interest into 'Other'
@@ -44,18 +53,43 @@ def process_older_stats():
 def process_newer_stats():
     stats = pd.read_csv(
         path.join(data_path, 'newer_stats.csv'), sep='\t',
-        infer_datetime_format=True, parse_dates=['Date']
+        parse_dates=['Date']
     )
     stats = stats.drop(['Portal'], axis=1)
     return stats
 
 
-def load_combined_df():
+def combine_stats():
     return pd.concat(
         [process_older_stats(), process_newer_stats()], ignore_index=True
     )
 
 
+def load_combined_df(use_cache=True):
+    """
+    Returns combined stats, read from the Parquet file they're cached
+    in unless the csv files changed since it was written. Without a
+    Parquet engine (pyarrow or fastparquet) nothing is cached.
+    """
+    combined_path = path.join(data_path, COMBINED_FILE)
+    if use_cache and path.exists(combined_path) and all(
+        path.getmtime(path.join(data_path, file_name))
+        <= path.getmtime(combined_path)
+        for file_name in STATS_FILES
+    ):
+        try:
+            return pd.read_parquet(combined_path)
+        except ImportError:
+            use_cache = False
+    stats = combine_stats()
+    if use_cache:
+        try:
+            stats.to_parquet(combined_path, index=False)
+        except ImportError:
+            pass
+    return stats
+
+
 def plot(df):
     g = gp.ggplot(df, gp.aes(x='Date', y='value', color='variable')) + \
         gp.geom_line()
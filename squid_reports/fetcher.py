@@ -0,0 +1,114 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+from os import path
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DATA_FILE_TEMPLATE = (
+    'https://stats.wikimedia.org/archive/squid_reports/'
+    '{year}-{month:02d}/SquidReportPageViewsPerCountryBreakdown.htm'
+)
+CACHE_DIR = path.join(path.dirname(path.realpath(__file__)), 'data', 'cache')
+
+
+# Downloads squid reports of several months at once through one pooled
+# session. Every report is cached on disk as YYYY-MM.htm next to
+# YYYY-MM.json with its ETag and Last-Modified headers, later runs send
+# them back with conditional GETs and get 304 Not Modified instead of
+# the report if it hasn't changed.
+
+
+def month_key(year, month):
+    return '{:04d}-{:02d}'.format(year, month)
+
+
+class SquidReportsFetcher:
+    def __init__(self, cache_dir=CACHE_DIR, url_template=DATA_FILE_TEMPLATE,
+                 workers=8, timeout=60, retries=3):
+        self.cache_dir = cache_dir
+        self.url_template = url_template
+        self.workers = workers
+        self.timeout = timeout
+        os.makedirs(cache_dir, exist_ok=True)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=workers, pool_maxsize=workers,
+            max_retries=Retry(
+                total=retries, backoff_factor=1,
+                status_forcelist=(500, 502, 503, 504),
+            ),
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.session.close()
+
+    def _cache_paths(self, year, month):
+        key = month_key(year, month)
+        return (
+            path.join(self.cache_dir, key + '.htm'),
+            path.join(self.cache_dir, key + '.json'),
+        )
+
+    def _read_cache(self, year, month):
+        """Returns (body, validators) of the cached report or (None, {})"""
+        body_path, meta_path = self._cache_paths(year, month)
+        if not (path.exists(body_path) and path.exists(meta_path)):
+            return None, {}
+        with open(meta_path) as meta_file:
+            validators = json.load(meta_file)
+        with open(body_path, 'rb') as body_file:
+            return body_file.read(), validators
+
+    def _write_cache(self, year, month, body, validators):
+        body_path, meta_path = self._cache_paths(year, month)
+        # body goes first, validators without their body are useless
+        for file_path, mode, data in (
+            (body_path, 'wb', body),
+            (meta_path, 'w', json.dumps(validators)),
+        ):
+            tmp_path = file_path + '.tmp'
+            with open(tmp_path, mode) as file_:
+                file_.write(data)
+            os.replace(tmp_path, file_path)
+
+    def fetch(self, year, month):
+        """Returns html of the month's report (bytes)"""
+        body, validators = self._read_cache(year, month)
+        headers = {}
+        if 'etag' in validators:
+            headers['If-None-Match'] = validators['etag']
+        if 'last_modified' in validators:
+            headers['If-Modified-Since'] = validators['last_modified']
+        resp = self.session.get(
+            self.url_template.format(year=year, month=month),
+            headers=headers, timeout=self.timeout,
+        )
+        if resp.status_code == 304 and body is not None:
+            return body
+        resp.raise_for_status()
+        validators = {}
+        if 'ETag' in resp.headers:
+            validators['etag'] = resp.headers['ETag']
+        if 'Last-Modified' in resp.headers:
+            validators['last_modified'] = resp.headers['Last-Modified']
+        self._write_cache(year, month, resp.content, validators)
+        return resp.content
+
+    def fetch_months(self, months):
+        """
+        Downloads reports of (year, month) pairs concurrently, returns
+        a list of their html in the same order.
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(lambda ym: self.fetch(*ym), months))
@@ -2,43 +2,58 @@ from datetime import date
 from collections import namedtuple
 from os import path
 
-from bs4 import BeautifulSoup
+import lxml.html
 import pandas as pd
-import requests
 
-DATA_FILE_TEMPLATE = (
-    'https://stats.wikimedia.org/archive/squid_reports/'
-    '{year}-{month:02d}/SquidReportPageViewsPerCountryBreakdown.htm'
-)
+from squid_reports.fetcher import SquidReportsFetcher
+
 month_of_year = namedtuple('Month', ['year', 'month'])
 file_dir = path.dirname(path.realpath(__file__))
 
 
-def get_data_file(year, month):
-    resp = requests.get(
-        DATA_FILE_TEMPLATE.format(year=year, month=month)
-    )
-    resp.raise_for_status()
-    return resp.text
+def get_data_file(year, month, fetcher=None):
+    if fetcher is None:
+        with SquidReportsFetcher() as fetcher:
+            return fetcher.fetch(year, month)
+    return fetcher.fetch(year, month)
 
 
 def strip_percents(string):
     return float(string.strip('%'))
 
 
-def parse_country_views(country_name, html):
-    soup = BeautifulSoup(html, 'html.parser')
-    lang_header = soup.find('a', id=country_name).parent.parent
-    views = {}
-    for sibling in lang_header.nextSiblingGenerator():
-        header = sibling.find('th')
-        if header == -1:
+def parse_countries_views(html):
+    """
+    Returns {country: {language: percent of views}} of all countries
+    in the report. A country's header row has a th of class lh3 with
+    an anchor named after the country, rows of its languages follow.
+    """
+    countries = {}
+    views = table = None
+    for row in lxml.html.fromstring(html).iter('tr'):
+        if row.getparent() is not table:
+            # a new table, languages don't continue from the last one
+            table = row.getparent()
+            views = None
+        header = row.find('th')
+        if header is None:
             continue
-        elif 'lh3' in header.attrs['class']:
-            return views
-        else:
-            value = strip_percents(sibling.find('td', class_='c').text)
-            views[header.text] = value
+        if 'lh3' in header.get('class', '').split():
+            anchors = row.xpath('.//a[@id]')
+            views = None
+            if anchors:
+                views = countries.setdefault(anchors[0].get('id'), {})
+        elif views is not None:
+            value = row.xpath('td[contains(concat(" ", @class, " "), " c ")]')
+            if value:
+                views[header.text_content()] = strip_percents(
+                    value[0].text_content()
+                )
+    return countries
+
+
+def parse_country_views(country_name, html):
+    return parse_countries_views(html)[country_name]
 
 
 def generate_date_range(start, end):
@@ -48,19 +63,52 @@ def generate_date_range(start, end):
         yield(date(year=year, month=month, day=1))
 
 
+def make_df(rows):
+    """
+    Makes a DataFrame of views dicts with columns of the first one,
+    languages missing in later months get 0
+    """
+    columns = list(rows[0].keys())
+    return pd.DataFrame(
+        [[row.get(col, 0) for col in columns] for row in rows],
+        columns=columns,
+    )
+
+
+def load_countries_data(country_names,
+                        start_date=month_of_year(2014, 12),
+                        end_date=month_of_year(2016, 8), fetcher=None):
+    """
+    Returns {country name: DataFrame} with monthly views of countries.
+    Every month is downloaded (or taken from the cache) and parsed
+    once for all countries.
+    """
+    dates = list(generate_date_range(start_date, end_date))
+    months = [(date_.year, date_.month) for date_ in dates]
+    if fetcher is None:
+        with SquidReportsFetcher() as fetcher:
+            htmls = fetcher.fetch_months(months)
+    else:
+        htmls = fetcher.fetch_months(months)
+    rows = {country_name: [] for country_name in country_names}
+    for date_, html in zip(dates, htmls):
+        countries = parse_countries_views(html)
+        for country_name in country_names:
+            views_dict = dict(countries[country_name])
+            views_dict['Date'] = date_
+            rows[country_name].append(views_dict)
+    return {
+        country_name: make_df(country_rows)
+        for country_name, country_rows in rows.items()
+    }
+
+
 def load_data(country_name='Ukraine',
               start_date=month_of_year(2014, 12),
-              end_date=month_of_year(2016, 8)):
-    df = None
-    for date_ in generate_date_range(start_date, end_date):
-        html = get_data_file(date_.year, date_.month)
-        views_dict = parse_country_views(country_name, html)
-        views_dict['Date'] = date_
-        if df is None:
-            df = pd.DataFrame(columns=views_dict.keys())
-        # fill missing values with Nones
-        df.loc[len(df)] = [views_dict.get(col, 0) for col in df.columns]
-    return df
+              end_date=month_of_year(2016, 8), fetcher=None):
+    return load_countries_data(
+        [country_name], start_date, end_date, fetcher
+    )[country_name]
 
 
 if __name__ == '__main__':
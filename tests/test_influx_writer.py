@@ -0,0 +1,104 @@
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+import json
+import re
+import threading
+
+from influxdb import InfluxDBClient
+import pytest
+
+from pageviews_parse.influx_writer import InfluxBatchWriter
+
+VALID_LINE = re.compile(r'^page_views,title=\S+ value=\d+i \d+$')
+
+
+class InfluxStub(BaseHTTPRequestHandler):
+    """
+    Accepts line protocol writes. Answers with the status codes in
+    'failures' first, then rejects writes with lines that don't
+    match VALID_LINE the way InfluxDB does and stores the others.
+    """
+    failures = []
+    requests = []
+    lines = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        lines = self.rfile.read(length).decode('utf-8').splitlines()
+        self.requests.append(lines)
+        if self.failures:
+            self.answer(self.failures.pop(0), {'error': 'overloaded'})
+        elif not all(VALID_LINE.match(line) for line in lines):
+            self.answer(400, {'error': 'unable to parse line'})
+        else:
+            self.lines.extend(lines)
+            self.answer(204)
+
+    def answer(self, status, content=None):
+        body = json.dumps(content).encode('utf-8') if content else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def influx():
+    InfluxStub.failures = []
+    InfluxStub.requests = []
+    InfluxStub.lines = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), InfluxStub)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+def make_writer(port, **options):
+    client = InfluxDBClient('127.0.0.1', port, database='wiki_pageviews')
+    options.setdefault('flush_interval', 60.0)
+    return InfluxBatchWriter(client=client, retry_delay=0, **options)
+
+
+def daily_views(days):
+    return {
+        '2011-12-{:02d}T00:00:00'.format(day + 1): day for day in range(days)
+    }
+
+
+def test_points_are_written_in_batches(influx):
+    with make_writer(influx, batch_size=3) as writer:
+        writer.write('Київ', daily_views(7))
+    assert [len(lines) for lines in InfluxStub.requests] == [3, 3, 1]
+    assert writer.points_written == 7
+    assert InfluxStub.lines[0] == 'page_views,title=Київ value=0i 1322697600'
+
+
+def test_server_errors_are_retried(influx):
+    InfluxStub.failures = [500, 503]
+    with make_writer(influx, retries=3) as writer:
+        writer.write('Київ', daily_views(2))
+    assert len(InfluxStub.requests) == 3
+    assert writer.points_written == 2
+    assert writer.failed_batches == 0
+
+
+def test_only_rejected_lines_are_dropped(influx, tmp_path):
+    rejected_file = tmp_path / 'rejected'
+    bad_line = 'page_views,title=Львів value=many 1322697600'
+    with make_writer(influx, rejected_file=str(rejected_file)) as writer:
+        writer.write('Київ', daily_views(2))
+        writer.write_lines([bad_line])
+        writer.write('Ірпінь', daily_views(2))
+    assert writer.points_written == 4
+    assert writer.points_rejected == 1
+    assert writer.points_dropped == 0
+    # 5 lines, then halves of 2 and 3 lines, then 1 and 2 of the 3
+    assert [len(lines) for lines in InfluxStub.requests] == [5, 2, 3, 1, 2]
+    assert len(InfluxStub.lines) == 4
+    assert rejected_file.read_text(encoding='utf-8') == bad_line + '\n'
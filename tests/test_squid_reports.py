@@ -0,0 +1,93 @@
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+import threading
+
+import pytest
+
+from squid_reports.fetcher import SquidReportsFetcher
+from squid_reports.load_data import load_countries_data
+from squid_reports.load_data import month_of_year
+from squid_reports.load_data import parse_countries_views
+
+REPORT = '''<html><body>
+<table>
+<tr><th class="lh3" colspan="2"><a id="Ukraine">Ukraine</a></th></tr>
+<tr><th>Uk Wp</th><td class="c">54.1%</td></tr>
+<tr><th>Ru Wp</th><td class="c">40.2%</td></tr>
+<tr><th class="lh3" colspan="2"><a id="Poland">Poland</a></th></tr>
+<tr><th>Pl Wp</th><td class="c">90%</td></tr>
+</table>
+<table>
+<tr><th>Uk Wp</th><td class="c">1%</td></tr>
+</table>
+</body></html>'''
+ETAG = '"report-1"'
+
+
+class SquidStub(BaseHTTPRequestHandler):
+    """Serves REPORT for every month, 304 if the client has its ETag"""
+    statuses = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.headers.get('If-None-Match') == ETAG:
+            self.statuses.append(304)
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = REPORT.encode('utf-8')
+        self.statuses.append(200)
+        self.send_response(200)
+        self.send_header('ETag', ETAG)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def fetcher(tmp_path):
+    SquidStub.statuses = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SquidStub)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url_template = 'http://127.0.0.1:{}/{{year}}-{{month:02d}}.htm'.format(
+        server.server_address[1]
+    )
+    fetcher = SquidReportsFetcher(str(tmp_path), url_template, workers=2)
+    yield fetcher
+    fetcher.close()
+    server.shutdown()
+    server.server_close()
+
+
+def test_unchanged_reports_come_from_the_cache(fetcher, tmp_path):
+    first = fetcher.fetch(2015, 1)
+    second = fetcher.fetch(2015, 1)
+    assert SquidStub.statuses == [200, 304]
+    assert first == second == REPORT.encode('utf-8')
+    assert sorted(file_.name for file_ in tmp_path.iterdir()) == [
+        '2015-01.htm', '2015-01.json',
+    ]
+
+
+def test_countries_are_parsed():
+    assert parse_countries_views(REPORT) == {
+        'Ukraine': {'Uk Wp': 54.1, 'Ru Wp': 40.2},
+        'Poland': {'Pl Wp': 90.0},
+    }
+
+
+def test_countries_data_has_a_row_per_month(fetcher):
+    data = load_countries_data(
+        ['Ukraine', 'Poland'], month_of_year(2015, 1),
+        month_of_year(2015, 3), fetcher,
+    )
+    assert SquidStub.statuses == [200] * 3
+    assert list(data['Ukraine'].columns) == ['Uk Wp', 'Ru Wp', 'Date']
+    assert data['Ukraine']['Uk Wp'].tolist() == [54.1] * 3
+    assert data['Poland']['Date'].astype(str).tolist() == [
+        '2015-01-01', '2015-02-01', '2015-03-01',
+    ]
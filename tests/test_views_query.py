@@ -0,0 +1,153 @@
+from datetime import date
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+import json
+import re
+import threading
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+import pytest
+
+from pageviews_parse.views_query import PageviewsQuery
+
+DEC_1 = 1322697600
+HOUR = 3600
+DAY = 24 * HOUR
+
+
+class InfluxStub(BaseHTTPRequestHandler):
+    """
+    Answers the InfluxQL queries PageviewsQuery makes from 'points':
+    {retention policy (None for the default one): {title: [(time, views)]}}
+    """
+    points = {}
+    queries = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.answer(parse_qs(urlparse(self.path).query)['q'][0])
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        params = parse_qs(urlparse(self.path).query)
+        params.update(parse_qs(self.rfile.read(length).decode('utf-8')))
+        self.answer(params['q'][0])
+
+    def answer(self, query):
+        self.queries.append(query)
+        policy = re.search(r'FROM (?:"(\w+)"\.)?"page_views"', query).group(1)
+        start = int(re.search(r'time >= (\d+)s', query).group(1))
+        end_operator, end = re.search(r'time (<=?) (\d+)s', query).groups()
+        end = int(end) + (1 if end_operator == '<=' else 0)
+        titles = [
+            re.sub(r'\\(.)', r'\1', title) for title in
+            re.findall(r"\"title\" = '((?:[^'\\]|\\.)*)'", query)
+        ]
+        series = []
+        for title, title_points in sorted(self.points.get(policy, {}).items()):
+            if titles and title not in titles:
+                continue
+            values = [[time_, views] for time_, views in title_points
+                      if start <= time_ < end]
+            if not values:
+                continue
+            if 'sum(' in query:
+                values = [[start, sum(views for _, views in values)]]
+            series.append({
+                'name': 'page_views', 'tags': {'title': title},
+                'columns': ['time', 'value'], 'values': values,
+            })
+        result = {'statement_id': 0}
+        if series:
+            result['series'] = series
+        body = json.dumps({'results': [result]}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def influx():
+    InfluxStub.points = {
+        None: {
+            'Київ': [(DEC_1, 1), (DEC_1 + DAY, 2), (DEC_1 + 7 * DAY, 5)],
+            'Львів': [(DEC_1, 4), (DEC_1 + 30 * DAY, 9)],
+            "It's": [(DEC_1 + 4 * DAY, 1)],
+        },
+        'hourly': {
+            'Київ': [
+                (DEC_1 + 30 * DAY + hour * HOUR, 1) for hour in range(24)
+            ],
+        },
+        # weeks are split at the month boundary: 2011-11-28 (Monday)
+        # has a partial point on the 1st of December
+        'weekly': {
+            'Київ': [(DEC_1 - 3 * DAY, 2), (DEC_1, 3), (DEC_1 + 4 * DAY, 5)],
+        },
+    }
+    InfluxStub.queries = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), InfluxStub)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+def make_query(port, **options):
+    return PageviewsQuery('127.0.0.1', port, **options)
+
+
+def test_series_are_fetched_in_chunks(influx):
+    query = make_query(influx, chunk_size=2)
+    df = query.get_series(
+        ['Київ', 'Львів', "It's", 'Нема'], date(2011, 12, 1),
+        date(2011, 12, 31),
+    )
+    assert len(InfluxStub.queries) == 2
+    assert list(df.columns) == ['Київ', 'Львів', "It's", 'Нема']
+    assert df.sum().tolist() == [8, 13, 1, 0]
+    assert df.loc['2011-12-01'].tolist() == [1, 4, 0, 0]
+
+
+def test_end_date_includes_its_hours(influx):
+    query = make_query(influx)
+    df = query.get_series(
+        ['Київ'], date(2011, 12, 31), date(2011, 12, 31), 'hour'
+    )
+    assert len(df) == 24
+
+
+def test_partial_weeks_are_summed(influx):
+    query = make_query(influx)
+    df = query.get_series(
+        ['Київ'], date(2011, 11, 1), date(2011, 12, 31), 'week'
+    )
+    assert df.index.strftime('%Y-%m-%d').tolist() == [
+        '2011-11-28', '2011-12-05',
+    ]
+    assert df['Київ'].tolist() == [5, 5]
+
+
+def test_top_n(influx):
+    query = make_query(influx)
+    assert query.top_n(date(2011, 12, 1), date(2011, 12, 31), 2) == [
+        ('Львів', 13), ('Київ', 8),
+    ]
+
+
+def test_results_are_cached_until_they_expire(influx):
+    now = [0.0]
+    query = make_query(influx, cache_ttl=60)
+    query.cache.clock = lambda: now[0]
+    for _ in range(2):
+        query.get_series(['Київ'], date(2011, 12, 1), date(2011, 12, 31))
+    assert len(InfluxStub.queries) == 1
+    now[0] = 61.0
+    query.get_series(['Київ'], date(2011, 12, 1), date(2011, 12, 31))
+    assert len(InfluxStub.queries) == 2
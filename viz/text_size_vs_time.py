@@ -1,45 +1,165 @@
-import sys
+import argparse
+from os import path
 
+import numpy as np
 import pandas as pd
+from sqlalchemy import select
 # this is just for the beauty
 import seaborn
+import matplotlib
 import matplotlib.pyplot as plt
-from toolz.functoolz import pipe
 
-from db.db_conf import TestSession
-from db.wiki_tables import Page
+from db.db_conf import get_engine
+from db.title_resolver import TitleResolver
+from db.wiki_tables import Revision
 
+# Sizes of revisions are read as two columns straight from the
+# revisions table (in order of the (page_id, timestamp) index) in
+# chunks of a server-side cursor. Long histories can be downsampled
+# to min, max and last size per time bucket before plotting.
 
-session = TestSession()
+FETCH_SIZE = 10000
+HISTORY_INDEX = next(
+    index for index in Revision.__table__.indexes
+    if index.name == 'ix_revisions_page_id_timestamp'
+)
 
 
-def get_page(page_name):
-    # FIXME this filter is case insensitive
-    # for some articles like 'Білі хорвати' it
-    # results in an error
-    return (session.query(Page)
-            .filter(Page.title == page_name)
-            .one())
+def get_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("titles", nargs='+', help="Titles of pages to plot")
+    parser.add_argument(
+        "-b", "--bucket",
+        help="Downsample to buckets of this length (numpy timedelta "
+             "like 7D or 12h)"
+    )
+    parser.add_argument(
+        "-o", "--output-dir",
+        help="Save plots as png files here instead of showing them"
+    )
+    parser.add_argument(
+        "--db-url", help="Database to use instead of the test one"
+    )
+    parser.add_argument(
+        "--create-index", action="store_true",
+        help="Create the (page_id, timestamp) index if it's missing"
+    )
+    return parser
 
 
-def construct_df(page):
-    return pd.DataFrame(
-        [(r.timestamp, r.text_size) for r in page.revisions],
-        columns=['timestamp', 'text_size']
+def parse_bucket(bucket):
+    """Converts '7D' or '12h' to numpy timedelta64"""
+    count = int(bucket[:-1] or 1)
+    return np.timedelta64(count, bucket[-1])
+
+
+def get_size_history(conn, page_id, fetch_size=FETCH_SIZE):
+    """
+    Returns (timestamps, sizes) arrays of revisions of the page in time
+    order, sizes of revisions without text are nan
+    """
+    result = conn.execution_options(stream_results=True).execute(
+        select([Revision.timestamp, Revision.text_size])
+        .where(Revision.page_id == page_id)
+        .order_by(Revision.timestamp)
     )
+    timestamps = []
+    sizes = []
+    while True:
+        rows = result.fetchmany(fetch_size)
+        if not rows:
+            break
+        chunk_timestamps, chunk_sizes = zip(*rows)
+        timestamps.append(np.array(chunk_timestamps, dtype='datetime64[s]'))
+        sizes.append(np.array(chunk_sizes, dtype=float))
+    if not timestamps:
+        return np.array([], 'datetime64[s]'), np.array([], float)
+    return np.concatenate(timestamps), np.concatenate(sizes)
+
 
+def downsample(timestamps, sizes, bucket):
+    """
+    Returns DataFrame with start of every bucket that has revisions
+    and min, max and last size in it
+    """
+    if not len(timestamps):
+        return pd.DataFrame(columns=['timestamp', 'min', 'max', 'last'])
+    # buckets are aligned to the epoch, so days start at midnight
+    origin = np.datetime64(0, 's')
+    buckets = (timestamps - origin) // bucket
+    _, starts = np.unique(buckets, return_index=True)
+    ends = np.append(starts[1:], len(sizes))
+    return pd.DataFrame({
+        'timestamp': origin + buckets[starts] * bucket,
+        'min': np.fmin.reduceat(sizes, starts),
+        'max': np.fmax.reduceat(sizes, starts),
+        'last': sizes[ends - 1],
+    })
 
-def plot_size_vs_time(df):
-    ax = df.plot('timestamp', 'text_size', kind='line', c='gray')
-    df.plot('timestamp', 'text_size', kind='line', style='.', c='red', ax=ax)
+
+def construct_df(conn, page_id, bucket=None):
+    timestamps, sizes = get_size_history(conn, page_id)
+    if bucket is not None:
+        return downsample(timestamps, sizes, bucket)
+    return pd.DataFrame({'timestamp': timestamps, 'text_size': sizes})
+
+
+def plot_size_vs_time(df, ax=None):
+    if 'text_size' in df:
+        ax = df.plot(
+            'timestamp', 'text_size', kind='line', c='gray', ax=ax
+        )
+        df.plot(
+            'timestamp', 'text_size', kind='line', style='.', c='red', ax=ax
+        )
+        return ax
+    ax = ax or plt.gca()
+    ax.fill_between(
+        df['timestamp'], df['min'], df['max'], color='gray', alpha=0.4,
+        step='post',
+    )
+    ax.plot(df['timestamp'], df['last'], c='red', drawstyle='steps-post')
+    ax.set_xlabel('timestamp')
+    ax.set_ylabel('text_size')
     return ax
 
+
+def plot_pages(engine, titles, bucket=None, output_dir=None):
+    """
+    Plots size histories of pages, one figure per page. Figures are
+    saved to output_dir (as <page id>.png) if it's given. Returns
+    titles that have no page.
+    """
+    page_ids = TitleResolver(engine).resolve(titles)
+    with engine.connect() as conn:
+        for title in titles:
+            if title not in page_ids:
+                continue
+            df = construct_df(conn, page_ids[title], bucket)
+            fig, ax = plt.subplots()
+            plot_size_vs_time(df, ax)
+            ax.set_title(title)
+            if output_dir:
+                fig.savefig(
+                    path.join(output_dir, '{}.png'.format(page_ids[title]))
+                )
+                plt.close(fig)
+    return [title for title in titles if title not in page_ids]
+
+
 if __name__ == '__main__':
-    page_name = sys.argv[1]
-    pipe(
-        page_name,
-        get_page,
-        construct_df,
-        plot_size_vs_time,
+    args = get_arg_parser().parse_args()
+    if args.output_dir:
+        matplotlib.use('Agg')
+    engine = get_engine('test', url=args.db_url)
+    if args.create_index:
+        HISTORY_INDEX.create(engine, checkfirst=True)
+    missing_titles = plot_pages(
+        engine, args.titles,
+        parse_bucket(args.bucket) if args.bucket else None,
+        args.output_dir,
     )
-    plt.show()
+    for title in missing_titles:
+        print('No page {}'.format(title))
+    if not args.output_dir:
+        plt.show()